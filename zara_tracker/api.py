@@ -0,0 +1,297 @@
+import datetime
+import inspect
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from zara_tracker.archive import read_price_history
+from zara_tracker.items import Product, Color, CrawlRun, DailyPriceChange, MODELS
+from zara_tracker.media import color_images
+from zara_tracker.settings import PRICE_ARCHIVE_DIRECTORY
+
+# Read-only JSON API over one market's database, see `scrapy api`.
+#
+#   GET /products?q=coat&market=WOMAN&after=<cursor>&limit=50
+#   GET /products/<zara id>                       colors and their price history
+#   GET /drops?date=2024-01-31&after=<cursor>     biggest price drops of a day
+#
+# Lists are paginated with the `next` cursor of the previous page. Responses
+# are cached until they expire or a crawl finishes writing to the database.
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    # LRU with a TTL, cleared whenever a newer finished crawl run shows up
+
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, body = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class PriceApi:
+    ROUTES = [
+        (re.compile(r"/products"), "search_products"),
+        (re.compile(r"/products/(\d+)"), "product_history"),
+        (re.compile(r"/drops"), "price_drops"),
+        (re.compile(r"/health"), "health"),
+    ]
+    MAX_LIMIT = 200
+
+    def __init__(self, country, database, cache=None, archive_directory=PRICE_ARCHIVE_DIRECTORY, check_interval=5):
+        # one market per process: the models stay bound to this (read-only)
+        # database for the lifetime of the server, bind_ctx isn't thread safe
+        self.country = country
+        self.database = database
+        self.database.bind(MODELS)
+        self.cache = cache or ResponseCache()
+        self.archive_directory = archive_directory
+        self.check_interval = check_interval
+        self.checked_at = 0
+        self.finished_run = None  # (id, finished_at) of the latest finished crawl run
+        self.check_lock = threading.Lock()
+
+    def handle(self, path, params):
+        # -> (status, json body)
+        self.invalidate()
+
+        key = (path, tuple(sorted(params.items())))
+        body = self.cache.get(key)
+        if body is not None:
+            return 200, body
+
+        for pattern, name in self.ROUTES:
+            match = pattern.fullmatch(path)
+            if match:
+                break
+        else:
+            raise ApiError(404, f"No route for {path}")
+
+        handler = getattr(self, name)
+        unknown = params.keys() - inspect.signature(handler).parameters.keys()
+        if unknown:
+            raise ApiError(400, f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+        with self.database.connection_context():
+            payload = handler(*match.groups(), **params)
+
+        body = json.dumps(payload, default=str).encode()
+        if name != "health":
+            self.cache.set(key, body)
+        return 200, body
+
+    def invalidate(self):
+        # checking once per `check_interval` keeps the extra query off the hot path
+        if time.monotonic() - self.checked_at < self.check_interval or not self.check_lock.acquire(blocking=False):
+            return
+        try:
+            # a resumed run finishes more than once
+            with self.database.connection_context():
+                crawl_run = CrawlRun \
+                    .select(CrawlRun.id, CrawlRun.finished_at) \
+                    .where(CrawlRun.finished_at.is_null(False)) \
+                    .order_by(CrawlRun.finished_at.desc()) \
+                    .tuples() \
+                    .first()
+            if crawl_run != self.finished_run:
+                if self.finished_run is not None:
+                    logging.info(f"{self.country} - Crawl run {crawl_run[0]} finished, clearing cache")
+                self.cache.clear()
+                self.finished_run = crawl_run
+            self.checked_at = time.monotonic()
+        finally:
+            self.check_lock.release()
+
+    def limit(self, limit):
+        try:
+            return max(1, min(self.MAX_LIMIT, int(limit)))
+        except ValueError:
+            raise ApiError(400, "limit must be a number")
+
+    def search_products(self, q=None, market=None, after=None, limit=50):
+        limit = self.limit(limit)
+        query = Product \
+            .select(Product.id, Product.zara_id, Product.name, Product.market, Product.category, Product.url) \
+            .order_by(Product.id) \
+            .limit(limit)
+        if q:
+            query = query.where(Product.name.contains(q))
+        if market:
+            query = query.where(Product.market == market.upper())
+        if after:
+            query = query.where(Product.id > self.cursor(after, 1)[0])
+
+        products = list(query.dicts())
+        return {
+            "products": [{
+                "id": product["zara_id"],
+                "name": product["name"],
+                "market": product["market"],
+                "category": product["category"],
+                "url": product["url"],
+            } for product in products],
+            "next": str(products[-1]["id"]) if len(products) == limit else None,
+        }
+
+    def product_history(self, zara_id, start=None, end=None):
+        product = Product.get_or_none(Product.zara_id == int(zara_id))
+        if product is None:
+            raise ApiError(404, f"Product {zara_id} not found")
+
+        history = {}
+        for point in read_price_history(self.country, product.zara_id, self.date(start), self.date(end), self.archive_directory):
+            history.setdefault(point.color_zara_id, []).append({
+                "at": point.created_at,
+                "price": point.price,
+                "old_price": point.old_price,
+                "original_price": point.original_price,
+            })
+
+        colors = list(product.colors.order_by(Color.zara_id))
+        images = color_images(color.id for color in colors)
+        return {
+            "id": product.zara_id,
+            "name": product.name,
+            "market": product.market,
+            "category": product.category,
+            "url": product.url,
+            "colors": [{
+                "id": color.zara_id,
+                "name": color.name,
+                "image": images.get(color.id, [None])[0],
+                "prices": history.get(color.zara_id, []),
+            } for color in colors],
+        }
+
+    def price_drops(self, date=None, after=None, limit=50, min_percent=1):
+        limit = self.limit(limit)
+        date = (self.date(date) or datetime.datetime.now()).date()
+        try:
+            min_percent = float(min_percent)
+        except ValueError:
+            raise ApiError(400, "min_percent must be a number")
+
+        query = DailyPriceChange \
+            .select(Product.zara_id, Product.name, Product.market, Product.url, Color.id, Color.zara_id.alias('color_zara_id'),
+                    Color.name.alias('color_name'), DailyPriceChange.previous_price, DailyPriceChange.price,
+                    DailyPriceChange.percent) \
+            .join(Color) \
+            .join_from(DailyPriceChange, Product) \
+            .where((DailyPriceChange.date == date) & (DailyPriceChange.percent <= -min_percent)) \
+            .order_by(DailyPriceChange.percent, Color.id) \
+            .limit(limit)
+        if after:
+            after_percent, after_color = self.drop_cursor(after)
+            query = query.where(
+                (DailyPriceChange.percent > after_percent) |
+                ((DailyPriceChange.percent == after_percent) & (Color.id > after_color))
+            )
+
+        rows = list(query.dicts())
+        images = color_images(row["id"] for row in rows)
+        return {
+            "date": date,
+            "drops": [{
+                "id": row["zara_id"],
+                "name": row["name"],
+                "market": row["market"],
+                "url": row["url"],
+                "color": {"id": row["color_zara_id"], "name": row["color_name"]},
+                "image": images.get(row["id"], [None])[0],
+                "previous_price": row["previous_price"],
+                "price": row["price"],
+                "percent": round(-row["percent"], 2),
+            } for row in rows],
+            "next": f"{rows[-1]['percent']!r}:{rows[-1]['id']}" if len(rows) == limit else None,
+        }
+
+    def health(self):
+        return {"country": self.country, "crawl_run": self.finished_run and self.finished_run[0]}
+
+    def cursor(self, value, parts):
+        try:
+            values = [int(part) for part in value.split(":")]
+        except ValueError:
+            values = []
+        if len(values) != parts:
+            raise ApiError(400, f"Invalid cursor {value}")
+        return values
+
+    def drop_cursor(self, value):
+        try:
+            percent, color_id = value.split(":")
+            return float(percent), int(color_id)
+        except ValueError:
+            raise ApiError(400, f"Invalid cursor {value}")
+
+    def date(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise ApiError(400, f"Invalid date {value}, expected YYYY-MM-DD")
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            status, body = self.server.api.handle(url.path.rstrip("/") or "/", params)
+        except ApiError as e:
+            status, body = e.status, json.dumps({"error": str(e)}).encode()
+        except Exception:
+            logging.exception(f"Failed to handle {self.path}")
+            status, body = 500, json.dumps({"error": "Internal error"}).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api: PriceApi):
+        super().__init__(address, ApiRequestHandler)
+        self.api = api
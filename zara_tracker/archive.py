@@ -0,0 +1,269 @@
+import datetime
+import logging
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import NamedTuple
+
+from peewee import fn, chunked, SQL
+from zara_tracker.items import Product, Color, ColorPriceTrace
+from zara_tracker.settings import PRICE_ARCHIVE_DIRECTORY
+
+# Cold storage for ColorPriceTrace history, one columnar file per market and
+# month: <PRICE_ARCHIVE_DIRECTORY>/<country>/<YYYY-MM>.zpt
+#
+#   b"ZPT1" | row count (uint64) | one little endian int64 array per column
+#
+# Nullable prices are stored as -1 and timestamps as microseconds since the
+# epoch (naive, like the database). Zara ids are stored next to the color id
+# so partitions can be read without the hot database.
+#
+# Rows are sorted by (color id, created_at). Lookups of one product use a per
+# partition index of the row ranges of its colors and only read those slices.
+
+MAGIC = b"ZPT1"
+HEADER = struct.Struct("<4sQ")
+COLUMNS = ["id", "color_id", "product_zara_id", "color_zara_id", "created_at", "price", "old_price", "original_price"]
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# partition path -> ((mtime, size), {product zara id: [(start, stop), ...]})
+partition_indexes = {}
+
+
+class PricePoint(NamedTuple):
+    product_zara_id: int
+    color_zara_id: int
+    created_at: datetime.datetime
+    price: int
+    old_price: int | None
+    original_price: int | None
+
+
+def to_micros(value: datetime.datetime) -> int:
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(value: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def partition_path(country: str, month: str, directory=PRICE_ARCHIVE_DIRECTORY) -> str:
+    return os.path.join(directory, country, f"{month}.zpt")
+
+
+def read_header(f, path: str) -> int:
+    magic, rows = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a price archive")
+    return rows
+
+
+def read_column(f, rows: int, name: str, start: int, stop: int) -> array:
+    # rows [start, stop) of one column of an open partition holding `rows` rows
+    f.seek(HEADER.size + (COLUMNS.index(name) * rows + start) * 8)
+    column = array("q")
+    column.fromfile(f, stop - start)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+
+def read_partition(path: str) -> dict:
+    with open(path, "rb") as f:
+        rows = read_header(f, path)
+        return {name: read_column(f, rows, name, 0, rows) for name in COLUMNS}
+
+
+def partition_index(path: str) -> dict:
+    # product zara id -> row ranges of its colors, kept until the partition is rewritten
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = partition_indexes.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with open(path, "rb") as f:
+        rows = read_header(f, path)
+        colors = read_column(f, rows, "color_id", 0, rows)
+        products = read_column(f, rows, "product_zara_id", 0, rows)
+
+    # the rows of a color are contiguous, jump from one color to the next
+    index = {}
+    start = 0
+    while start < rows:
+        stop = bisect_right(colors, colors[start], start)
+        index.setdefault(products[start], []).append((start, stop))
+        start = stop
+
+    partition_indexes[path] = (version, index)
+    return index
+
+
+def read_ranges(path: str, ranges: list, low=None, high=None):
+    # price points of row ranges of single colors within [low, high) microseconds
+    with open(path, "rb") as f:
+        rows = read_header(f, path)
+        for start, stop in ranges:
+            # a color's rows are sorted by time
+            times = read_column(f, rows, "created_at", start, stop)
+            first = 0 if low is None else bisect_left(times, low)
+            last = len(times) if high is None else bisect_left(times, high)
+            if first >= last:
+                continue
+            columns = {
+                name: read_column(f, rows, name, start + first, start + last)
+                for name in ("product_zara_id", "color_zara_id", "price", "old_price", "original_price")
+            }
+            for i in range(last - first):
+                yield price_point(columns, i, times[first + i])
+
+
+def price_point(columns: dict, i: int, created_at: int) -> PricePoint:
+    old_price = columns["old_price"][i]
+    original_price = columns["original_price"][i]
+    return PricePoint(
+        columns["product_zara_id"][i],
+        columns["color_zara_id"][i],
+        from_micros(created_at),
+        columns["price"][i],
+        None if old_price == -1 else old_price,
+        None if original_price == -1 else original_price,
+    )
+
+
+def write_partition(path: str, columns: dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(columns["id"])))
+        for name in COLUMNS:
+            column = columns[name]
+            if sys.byteorder != "little":
+                column = array("q", column)
+                column.byteswap()
+            column.tofile(f)
+    os.replace(f"{path}.tmp", path)
+
+
+def merge_partition(path: str, rows: list) -> int:
+    # rows of COLUMNS order; traces archived by an interrupted run are skipped by id
+    columns = read_partition(path) if os.path.exists(path) else {name: array("q") for name in COLUMNS}
+    archived = set(columns["id"])
+    rows = [row for row in rows if row[0] not in archived]
+
+    merged = sorted(
+        [tuple(columns[name][i] for name in COLUMNS) for i in range(len(columns["id"]))] + rows,
+        key=lambda row: (row[1], row[4]),  # color, created_at
+    )
+    write_partition(path, {name: array("q", [row[i] for row in merged]) for i, name in enumerate(COLUMNS)})
+    return len(rows)
+
+
+def compact_price_traces(country: str, database, days: int, directory=PRICE_ARCHIVE_DIRECTORY) -> int:
+    # moves traces older than `days` into the archive, except the newest one of
+    # every color before the cutoff: it is the price the report compares against
+    cutoff = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=days), datetime.time())
+
+    kept = ColorPriceTrace \
+        .select(ColorPriceTrace.id, fn.MAX(ColorPriceTrace.created_at)) \
+        .where(ColorPriceTrace.created_at < cutoff) \
+        .group_by(ColorPriceTrace.color)
+    # sqlite returns the bare `id` column from the row holding MAX(created_at)
+    keep_ids = {trace_id for trace_id, _ in kept.tuples().iterator()}
+
+    months = ColorPriceTrace \
+        .select(fn.strftime('%Y-%m', ColorPriceTrace.created_at).alias('month')) \
+        .where(ColorPriceTrace.created_at < cutoff) \
+        .distinct() \
+        .order_by(SQL('month'))
+
+    archived = 0
+    for month, in months.tuples():
+        start = datetime.datetime.strptime(month, "%Y-%m")
+        end = min(cutoff, (start + datetime.timedelta(days=32)).replace(day=1))
+
+        rows = []
+        query = ColorPriceTrace \
+            .select(ColorPriceTrace.id, Color.id, Product.zara_id, Color.zara_id, ColorPriceTrace.created_at,
+                    ColorPriceTrace.price, ColorPriceTrace.old_price, ColorPriceTrace.original_price) \
+            .join(Color) \
+            .join(Product) \
+            .where((ColorPriceTrace.created_at >= start) & (ColorPriceTrace.created_at < end)) \
+            .tuples()
+        for trace_id, color_id, product_zara_id, color_zara_id, created_at, price, old_price, original_price in query.iterator():
+            if trace_id in keep_ids:
+                continue
+            rows.append((
+                trace_id, color_id, product_zara_id, color_zara_id, to_micros(created_at), price,
+                -1 if old_price is None else old_price,
+                -1 if original_price is None else original_price,
+            ))
+        if not rows:
+            continue
+
+        # the partition is written before the rows are deleted, a crash in
+        # between only leaves rows that are archived again (and skipped) next run
+        merge_partition(partition_path(country, month, directory), rows)
+        with database.atomic():
+            for chunk in chunked([row[0] for row in rows], 500):
+                ColorPriceTrace.delete().where(ColorPriceTrace.id.in_(chunk)).execute()
+
+        logging.info(f"{country} - Archived {len(rows)} price traces of {month}")
+        archived += len(rows)
+
+    return archived
+
+
+def read_archive(country: str, product_zara_id=None, start=None, end=None, directory=PRICE_ARCHIVE_DIRECTORY):
+    # archived price points of one market, optionally of one product and within [start, end)
+    market_directory = os.path.join(directory, country)
+    if not os.path.isdir(market_directory):
+        return
+    low = to_micros(start) if start is not None else None
+    high = to_micros(end) if end is not None else None
+
+    for name in sorted(os.listdir(market_directory)):
+        if not name.endswith(".zpt"):
+            continue
+        month = datetime.datetime.strptime(name[:-4], "%Y-%m")
+        if end is not None and month >= end:
+            continue
+        if start is not None and (month + datetime.timedelta(days=32)).replace(day=1) <= start:
+            continue
+
+        path = os.path.join(market_directory, name)
+        if product_zara_id is not None:
+            ranges = partition_index(path).get(product_zara_id)
+            if ranges:
+                yield from read_ranges(path, ranges, low, high)
+            continue
+
+        columns = read_partition(path)
+        times = columns["created_at"]
+        for i in range(len(times)):
+            if (low is not None and times[i] < low) or (high is not None and times[i] >= high):
+                continue
+            yield price_point(columns, i, times[i])
+
+
+def read_price_history(country: str, product_zara_id=None, start=None, end=None, directory=PRICE_ARCHIVE_DIRECTORY):
+    # archived and hot price points, ordered by color and time; the hot
+    # database of `country` must be bound (database.bind_ctx(MODELS))
+    query = ColorPriceTrace \
+        .select(Product.zara_id, Color.zara_id, ColorPriceTrace.created_at, ColorPriceTrace.price,
+                ColorPriceTrace.old_price, ColorPriceTrace.original_price) \
+        .join(Color) \
+        .join(Product) \
+        .tuples()
+    if product_zara_id is not None:
+        query = query.where(Product.zara_id == product_zara_id)
+    if start is not None:
+        query = query.where(ColorPriceTrace.created_at >= start)
+    if end is not None:
+        query = query.where(ColorPriceTrace.created_at < end)
+
+    points = list(read_archive(country, product_zara_id, start, end, directory))
+    points += [PricePoint(*row) for row in query.iterator()]
+    points.sort(key=lambda point: (point.product_zara_id, point.color_zara_id, point.created_at))
+    return points
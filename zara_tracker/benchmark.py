@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+
+from scrapy import Request
+from scrapy.http import TextResponse
+from scrapy.settings import Settings
+
+from zara_tracker import items
+from zara_tracker.instrumentation import metrics
+from zara_tracker.items import InstrumentedSqliteDatabase, database_pragmas
+from zara_tracker.pipelines import ZaraTrackerPipeline
+from zara_tracker.spiders.prices import PricesSpider
+
+# Offline replay of synthetic category listings through PricesSpider.parse_products
+# and ZaraTrackerPipeline into a throw away database, see `scrapy benchmark`.
+#
+# A run crawls the same catalogue `days` times. Every crawl after the first
+# changes the price of `changed` of the colors, a third of them by more than
+# the report threshold, so the pipeline and the discount report have work to do.
+
+COUNTRY = "bench"
+LANGUAGE = "en"
+MARKETS = ["WOMAN", "MAN", "KID", "BEAUTY", "ZARA ORIGINS"]
+
+
+def make_element(zara_id, crawl, colors, sizes, changed):
+    color_items = []
+    for c in range(colors):
+        price = 1000 + zara_id % 500 * 10
+        if crawl and (zara_id * colors + c) % round(1 / changed) == 0:
+            # alternate between a big drop and a small raise
+            price = price * 6 // 10 if (zara_id + crawl) % 3 == 0 else price + 100
+        color_items.append({
+            "id": 100 + c,
+            "productId": zara_id * 10 + c,
+            "name": f"COLOR {c}",
+            "price": price,
+            "oldPrice": None,
+            "xmedia": [{"path": f"2024/V/0/1/p/{zara_id}/{c}", "name": f"{zara_id}_{c}_1", "timestamp": 1700000000000}],
+            "sizes": [{
+                "id": s,
+                "name": "XS S M L XL XXL".split()[s % 6],
+                "availability": "in_stock" if (zara_id + s + crawl) % 7 else "out_of_stock",
+                "price": price,
+            } for s in range(sizes)],
+        })
+
+    return {"commercialComponents": [{
+        "name": f"PRODUCT {zara_id}",
+        "description": "Synthetic benchmark product",
+        "seo": {"keyword": f"product-{zara_id}", "seoProductId": str(zara_id), "discernProductId": zara_id * 10},
+        "detail": {"colors": color_items},
+    }]}
+
+
+def make_listing(first_id, count, crawl, colors, sizes, changed):
+    return json.dumps({"productGroups": [{"elements": [
+        make_element(zara_id, crawl, colors, sizes, changed) for zara_id in range(first_id, first_id + count)
+    ]}]})
+
+
+def run_benchmark(products, days=2, listing_size=500, colors=2, sizes=4, changed=0.1, track_sizes=False, streaming=False):
+    settings = Settings({"PRICES_STREAMING_JSON": streaming})
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = InstrumentedSqliteDatabase(os.path.join(directory, "zara.db"), pragmas=database_pragmas())
+        items.databases[COUNTRY] = database
+        try:
+            spider = PricesSpider(markets=f"{COUNTRY}:{LANGUAGE}")
+            spider.settings = settings
+            pipeline = ZaraTrackerPipeline(batch_size=500, batch_interval=0, track_sizes=track_sizes)
+            pipeline.open_spider(spider)
+            metrics.reset()
+
+            parse_time = store_time = 0.0
+            count = 0
+            for crawl in range(days):
+                for first_id in range(1, products + 1, listing_size):
+                    n = min(listing_size, products + 1 - first_id)
+                    body = make_listing(first_id, n, crawl, colors, sizes, changed)
+                    category = {"id": first_id, "name": f"category_{first_id // listing_size}"}
+                    url = f"https://www.zara.com/{COUNTRY}/{LANGUAGE}/category/{first_id}/products?ajax=true"
+                    response = TextResponse(url, body=body, encoding="utf-8", request=Request(url))
+
+                    started = time.perf_counter()
+                    parsed = list(spider.parse_products(response, MARKETS[first_id % len(MARKETS)], category, COUNTRY, LANGUAGE))
+                    parse_time += time.perf_counter() - started
+
+                    started = time.perf_counter()
+                    for item in parsed:
+                        pipeline.process_item(item, spider)
+                    store_time += time.perf_counter() - started
+                    count += len(parsed)
+
+                started = time.perf_counter()
+                pipeline.close_spider(spider)
+                store_time += time.perf_counter() - started
+            store_queries = metrics.statement_count()
+
+            metrics.reset()
+            started = time.perf_counter()
+            spider.share_market_discount_reports(COUNTRY, database)
+            report_time = time.perf_counter() - started
+            report_queries = metrics.statement_count()
+        finally:
+            database.close()
+            del items.databases[COUNTRY]
+
+    return {
+        "products": products,
+        "items": count,
+        "parse_seconds": round(parse_time, 3),
+        "store_seconds": round(store_time, 3),
+        "items_per_second": round(count / (parse_time + store_time)) if count else 0,
+        "queries_per_item": round(store_queries / count, 3) if count else 0,
+        "report_seconds": round(report_time, 3),
+        "report_queries": report_queries,
+        # linux reports kilobytes
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_isolated(**kwargs):
+    # peak RSS only means something in a fresh process
+    logging.disable(logging.INFO)
+    return run_benchmark(**kwargs)
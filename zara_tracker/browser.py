@@ -0,0 +1,23 @@
+# Request filter for scrapy-playwright (PLAYWRIGHT_ABORT_REQUEST). Product
+# data comes from the inline `window.zara.viewPayload` script, so everything
+# that is only needed to render or measure the page is aborted.
+
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet", "texttrack", "manifest"}
+
+BLOCKED_HOSTS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "facebook.net",
+    "facebook.com",
+    "hotjar.com",
+    "dynatrace.com",
+    "onetrust.com",
+    "cookielaw.org",
+)
+
+
+def should_abort_request(request) -> bool:
+    if request.resource_type in BLOCKED_RESOURCE_TYPES:
+        return True
+    return any(host in request.url for host in BLOCKED_HOSTS)
@@ -0,0 +1,79 @@
+import datetime
+import logging
+
+from peewee import chunked
+from zara_tracker.items import CrawlRun, CrawlListing
+from zara_tracker.settings import CRAWL_RESUME_MAX_AGE
+
+# Progress of a prices crawl, kept so an interrupted one costs only its
+# unfinished listings. A run spans every process working on it:
+#
+#   1. the listings it is going to crawl are planned before they are requested
+#   2. each one is marked done in the transaction storing its last products
+#   3. the next process of an interrupted run requests only the pending ones
+#   4. a run is completed when a process ends with reason `finished`, it is
+#      reported once, see PricesSpider.share_discount_reports
+#
+# The models of the market's writer database must be bound.
+
+
+def current_run(spider: str, resume=False, max_age=CRAWL_RESUME_MAX_AGE) -> CrawlRun:
+    # the unfinished run of `spider` started within `max_age` hours, or a new one
+    if resume:
+        started_after = datetime.datetime.now() - datetime.timedelta(hours=max_age)
+        run = CrawlRun \
+            .select() \
+            .where((CrawlRun.spider == spider) & CrawlRun.completed_at.is_null() & (CrawlRun.started_at > started_after)) \
+            .order_by(CrawlRun.id.desc()) \
+            .first()
+        if run is not None:
+            return run
+    return CrawlRun.create(spider=spider)
+
+
+def plan_listings(run: CrawlRun, listings: list):
+    # listings: (category id, market, name)
+    rows = [{'run': run.id, 'category_id': category_id, 'market': market, 'name': name} for category_id, market, name in listings]
+    for chunk in chunked(rows, 200):
+        CrawlListing.insert_many(chunk).on_conflict_ignore().execute()
+
+
+def planned_listings(run: CrawlRun) -> list:
+    # -> pending listings of the run, None if it didn't plan any yet
+    listings = list(CrawlListing.select().where(CrawlListing.run == run.id))
+    if not listings:
+        return None
+    return [listing for listing in listings if listing.done_at is None]
+
+
+def mark_listings_done(run: CrawlRun, category_ids):
+    now = datetime.datetime.now()
+    for ids in chunked(category_ids, 500):
+        CrawlListing \
+            .update(done_at=now) \
+            .where((CrawlListing.run == run.id) & CrawlListing.category_id.in_(ids) & CrawlListing.done_at.is_null()) \
+            .execute()
+
+
+def finish_run(run: CrawlRun, reason: str):
+    # every process of a run finishes it, only a crawl that ran out of
+    # requests completes it. Listings still pending then have failed
+    now = datetime.datetime.now()
+    values = {CrawlRun.finished_at: now, CrawlRun.reason: reason}
+    if reason == 'finished':
+        values[CrawlRun.completed_at] = now
+        pending = CrawlListing.select().where((CrawlListing.run == run.id) & CrawlListing.done_at.is_null()).count()
+        if pending:
+            logging.warning(f"Crawl run {run.id} completed with {pending} listings that failed")
+    CrawlRun.update(values).where(CrawlRun.id == run.id).execute()
+
+
+def unreported_runs(spider: str) -> list:
+    return list(CrawlRun
+                .select()
+                .where((CrawlRun.spider == spider) & CrawlRun.completed_at.is_null(False) & CrawlRun.reported_at.is_null())
+                .order_by(CrawlRun.id))
+
+
+def mark_reported(run: CrawlRun):
+    CrawlRun.update(reported_at=datetime.datetime.now()).where(CrawlRun.id == run.id).execute()
@@ -0,0 +1,47 @@
+import logging
+
+from scrapy.commands import ScrapyCommand
+
+from zara_tracker.api import PriceApi, ApiServer, ResponseCache
+from zara_tracker.items import get_database
+from zara_tracker.migrations import migrate
+from zara_tracker.settings import COUNTRY_CODE
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Serve the price history of one market as a read-only JSON API"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--market", default=COUNTRY_CODE, help="country code of the market to serve")
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8080)
+        parser.add_argument("--cache-size", type=int, default=1024, help="responses kept in memory")
+        parser.add_argument("--cache-ttl", type=float, default=300, help="seconds a cached response stays valid")
+
+    def run(self, args, opts):
+        # the api only reads, make sure the schema it expects exists first
+        database = get_database(opts.market)
+        with database.connection_context():
+            migrate(database)
+
+        api = PriceApi(
+            opts.market,
+            get_database(opts.market, readonly=True),
+            cache=ResponseCache(opts.cache_size, opts.cache_ttl),
+            archive_directory=self.settings.get('PRICE_ARCHIVE_DIRECTORY'),
+        )
+        server = ApiServer((opts.host, opts.port), api)
+        logging.info(f"{opts.market} - Serving price API on http://{opts.host}:{opts.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,71 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from zara_tracker.benchmark import run_isolated
+
+COLUMNS = [
+    ("products", "products"),
+    ("items", "items"),
+    ("items/s", "items_per_second"),
+    ("queries/item", "queries_per_item"),
+    ("parse s", "parse_seconds"),
+    ("store s", "store_seconds"),
+    ("report s", "report_seconds"),
+    ("peak rss MB", "peak_rss_mb"),
+]
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Replay synthetic listings through the prices spider and pipeline offline"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--products", default="1000,10000,100000", help="comma separated catalogue sizes, e.g. 1000,500000")
+        parser.add_argument("--days", type=int, default=2, help="crawls of the same catalogue")
+        parser.add_argument("--listing-size", type=int, default=500, help="products per category listing")
+        parser.add_argument("--colors", type=int, default=2, help="colors per product")
+        parser.add_argument("--sizes", type=int, default=4, help="sizes per color")
+        parser.add_argument("--changed", type=float, default=0.1, help="share of colors changing price per crawl")
+        parser.add_argument("--track-sizes", action="store_true", help="also store size traces")
+        parser.add_argument("--streaming", action="store_true", help="use the streaming listing decoder")
+        parser.add_argument("--json", dest="json_path", help="write the results to this file")
+
+    def run(self, args, opts):
+        try:
+            sizes = [int(size) for size in opts.products.split(",")]
+        except ValueError:
+            raise UsageError("--products must be a comma separated list of numbers")
+        if not 0 < opts.changed <= 1:
+            raise UsageError("--changed must be between 0 and 1")
+
+        print(" | ".join(f"{title:>12}" for title, _ in COLUMNS))
+        results = []
+        for products in sizes:
+            with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+                result = executor.submit(
+                    run_isolated,
+                    products=products,
+                    days=opts.days,
+                    listing_size=opts.listing_size,
+                    colors=opts.colors,
+                    sizes=opts.sizes,
+                    changed=opts.changed,
+                    track_sizes=opts.track_sizes,
+                    streaming=opts.streaming,
+                ).result()
+            results.append(result)
+            print(" | ".join(f"{result[key]:>12}" for _, key in COLUMNS))
+
+        if opts.json_path:
+            with open(opts.json_path, "w") as f:
+                json.dump(results, f, indent=2)
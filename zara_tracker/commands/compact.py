@@ -0,0 +1,45 @@
+import logging
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from zara_tracker.archive import compact_price_traces
+from zara_tracker.items import MODELS, get_database
+from zara_tracker.markets import parse_markets
+from zara_tracker.migrations import migrate
+from zara_tracker.settings import MARKETS
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Move old price traces into the monthly price archive"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--days", type=int, help="archive traces older than this many days (default: PRICE_ARCHIVE_AFTER_DAYS)")
+        parser.add_argument("--markets", default=MARKETS, help="markets to compact, e.g. pl:pl,nl:nl")
+        parser.add_argument("--directory", help="archive directory (default: PRICE_ARCHIVE_DIRECTORY)")
+        parser.add_argument("--vacuum", action="store_true", help="shrink the database file afterwards")
+
+    def run(self, args, opts):
+        days = opts.days if opts.days is not None else self.settings.getint('PRICE_ARCHIVE_AFTER_DAYS')
+        if days < 1:
+            raise UsageError("--days must be at least 1, the daily report needs yesterday's prices")
+        directory = opts.directory or self.settings.get('PRICE_ARCHIVE_DIRECTORY')
+
+        for country, _ in parse_markets(opts.markets):
+            database = get_database(country)
+            database.connect(reuse_if_open=True)
+            migrate(database)
+            with database.bind_ctx(MODELS):
+                archived = compact_price_traces(country, database, days, directory)
+            logging.info(f"{country} - Archived {archived} price traces older than {days} days")
+
+            if opts.vacuum and archived:
+                database.execute_sql('VACUUM')
+            database.close()
@@ -0,0 +1,87 @@
+import datetime
+import logging
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from zara_tracker.items import Notification, MODELS, get_database
+from zara_tracker.markets import parse_markets
+from zara_tracker.migrations import migrate
+from zara_tracker.settings import TG_TOKEN, MARKETS
+from zara_tracker.telegram import TelegramNotifier, send_telegram_message
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Deliver queued notifications from the outbox"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--follow", action="store_true", help="keep polling the outbox for new notifications")
+        parser.add_argument("--interval", type=float, default=60, help="seconds between outbox polls with --follow")
+        parser.add_argument("--batch-size", type=int, default=100, help="notifications sent concurrently")
+        parser.add_argument("--markets", default=MARKETS, help="markets to deliver for, e.g. pl:pl,nl:nl")
+
+    def run(self, args, opts):
+        if not TG_TOKEN:
+            raise UsageError("TG_TOKEN is not set")
+
+        databases = {country: get_database(country) for country, _ in parse_markets(opts.markets)}
+        for database in databases.values():
+            database.connect(reuse_if_open=True)
+            migrate(database)
+
+        notifier = TelegramNotifier()
+        try:
+            while True:
+                for country, database in databases.items():
+                    with database.bind_ctx(MODELS):
+                        self.drain(notifier, country, opts.batch_size)
+                if not opts.follow:
+                    break
+                time.sleep(opts.interval)
+        finally:
+            notifier.close()
+            for database in databases.values():
+                database.close()
+
+    def drain(self, notifier, country, batch_size):
+        max_attempts = self.settings.getint('NOTIFY_MAX_ATTEMPTS')
+        last_id = 0
+        sent = failed = 0
+
+        while True:
+            pending = list(Notification.select().where(
+                Notification.sent_at.is_null() &
+                (Notification.attempts < max_attempts) &
+                (Notification.id > last_id)
+            ).order_by(Notification.id).limit(batch_size))
+
+            if not pending:
+                break
+            last_id = pending[-1].id
+
+            # counted before sending, a crash mid-batch re-delivers those notifications (at least once)
+            Notification.update(attempts=Notification.attempts + 1) \
+                .where(Notification.id.in_([n.id for n in pending])) \
+                .execute()
+
+            futures = [(n, send_telegram_message(notifier, country, n.market, n.images.split(", "), n.message)) for n in pending]
+            for notification, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    Notification.update(error=str(e)).where(Notification.id == notification.id).execute()
+                    failed += 1
+                else:
+                    Notification.update(sent_at=datetime.datetime.now(), error=None).where(Notification.id == notification.id).execute()
+                    sent += 1
+
+        if sent or failed:
+            logging.info(f"{country} - Sent {sent} notifications, {failed} failed")
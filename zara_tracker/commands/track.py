@@ -0,0 +1,44 @@
+import re
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from zara_tracker.items import Product, MODELS, get_database
+from zara_tracker.settings import COUNTRY_CODE
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options] <product id or url> ..."
+
+    def short_desc(self):
+        return "Mark products to be watched for restocks by the zara spider"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--market", default=COUNTRY_CODE, help="country code of the product's market")
+        parser.add_argument("--off", action="store_true", help="stop tracking the products")
+
+    def run(self, args, opts):
+        if not args:
+            raise UsageError()
+
+        zara_ids = [self.zara_id(arg) for arg in args]
+
+        database = get_database(opts.market)
+        with database.bind_ctx(MODELS), database.connection_context():
+            updated = Product.update(tracking=not opts.off).where(Product.zara_id.in_(zara_ids)).execute()
+
+        print(f"{'Untracked' if opts.off else 'Tracking'} {updated} of {len(zara_ids)} products")
+
+    def zara_id(self, value):
+        # seoProductId or a product page url like .../name-p08417803.html?v1=...
+        match = re.search(r'-p(\d+)\.html', value)
+        if match:
+            return int(match.group(1))
+        if value.isdigit():
+            return int(value)
+        raise UsageError(f"Not a product id or url: {value}")
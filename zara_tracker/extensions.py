@@ -0,0 +1,108 @@
+import json
+import os
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from zara_tracker.instrumentation import metrics, BUCKETS
+
+
+class InstrumentationExtension:
+    # Publishes the stage timings and SQL counters collected in
+    # zara_tracker.instrumentation to the crawl stats (timing/<stage>/*,
+    # sql/<statement>/*) and optionally to a Prometheus textfile / JSON file.
+    #
+    # The discount report runs on engine_stopped, after the stats are dumped
+    # on spider_closed, so the files are written once the engine has stopped.
+
+    def __init__(self, stats, prometheus_file=None, json_file=None):
+        self.stats = stats
+        self.prometheus_file = prometheus_file
+        self.json_file = json_file
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("INSTRUMENTATION_ENABLED"):
+            raise NotConfigured
+        s = cls(
+            crawler.stats,
+            prometheus_file=crawler.settings.get("INSTRUMENTATION_PROMETHEUS_FILE"),
+            json_file=crawler.settings.get("INSTRUMENTATION_JSON_FILE"),
+        )
+        crawler.signals.connect(s.response_received, signal=signals.response_received)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        # connected after the spider's own engine_stopped handlers, so the report is included
+        crawler.signals.connect(s.engine_stopped, signal=signals.engine_stopped)
+        return s
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            metrics.observe("download", latency)
+
+    def spider_closed(self, spider):
+        self.publish()
+
+    def engine_stopped(self):
+        self.publish()
+        if self.prometheus_file:
+            self.write(self.prometheus_file, self.prometheus())
+        if self.json_file:
+            self.write(self.json_file, json.dumps(self.summary(), indent=2))
+
+    def publish(self):
+        summary = self.summary()
+        for stage, values in summary["stages"].items():
+            for name, value in values.items():
+                self.stats.set_value(f"timing/{stage}/{name}", value)
+        for kind, values in summary["statements"].items():
+            for name, value in values.items():
+                self.stats.set_value(f"sql/{kind}/{name}", value)
+
+    def summary(self):
+        return {
+            "stages": {stage: {
+                "count": histogram.count,
+                "seconds": round(histogram.sum, 3),
+                "max": round(histogram.max, 4),
+                "p50": round(histogram.quantile(0.5), 4),
+                "p95": round(histogram.quantile(0.95), 4),
+            } for stage, histogram in metrics.stages.items()},
+            "statements": {kind: {
+                "count": count,
+                "seconds": round(seconds, 3),
+            } for kind, (count, seconds) in metrics.statements.items()},
+        }
+
+    def prometheus(self):
+        lines = [
+            "# HELP zara_stage_seconds Time spent per crawl stage",
+            "# TYPE zara_stage_seconds histogram",
+        ]
+        for stage, histogram in metrics.stages.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'zara_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'zara_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'zara_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        lines += [
+            "# HELP zara_sql_statements_total SQL statements executed by type",
+            "# TYPE zara_sql_statements_total counter",
+        ]
+        lines += [f'zara_sql_statements_total{{statement="{kind}"}} {count}' for kind, (count, _) in metrics.statements.items()]
+        lines += [
+            "# HELP zara_sql_seconds_total Time spent executing SQL statements by type",
+            "# TYPE zara_sql_seconds_total counter",
+        ]
+        lines += [f'zara_sql_seconds_total{{statement="{kind}"}} {seconds}' for kind, (_, seconds) in metrics.statements.items()]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, content):
+        # node_exporter may read the file at any time, replace it atomically
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
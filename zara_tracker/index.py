@@ -0,0 +1,190 @@
+from array import array
+
+from peewee import fn
+from zara_tracker.items import Product, Color, Media, ColorMedia, ColorPriceTrace, Size, SizeAvailabilityTrace, SizePriceTrace, Photo
+
+
+class ColorPriceIndex:
+    # zara (product, color) ids -> (color db id, last price)
+    #
+    # zara color ids ("800", "401", ...) repeat across products, so entries are
+    # keyed by both ids packed into a single int. The values live in two
+    # parallel int64 arrays instead of one tuple per color.
+
+    def __init__(self):
+        self.slots = {}
+        self.color_ids = array('q')
+        self.prices = array('q')
+
+    def __len__(self):
+        return len(self.slots)
+
+    @staticmethod
+    def key(product_zara_id: int, color_zara_id: int):
+        # ids may still be strings when they come from a payload, the database has ints
+        product_zara_id, color_zara_id = int(product_zara_id), int(color_zara_id)
+        if 0 <= color_zara_id < 1 << 32:
+            return product_zara_id << 32 | color_zara_id
+        return (product_zara_id, color_zara_id)
+
+    def get(self, product_zara_id: int, color_zara_id: int):
+        slot = self.slots.get(self.key(product_zara_id, color_zara_id))
+        if slot is None:
+            return None
+        return self.color_ids[slot], self.prices[slot]
+
+    def set(self, product_zara_id: int, color_zara_id: int, color_id: int, price: int):
+        key = self.key(product_zara_id, color_zara_id)
+        slot = self.slots.get(key)
+        if slot is None:
+            self.slots[key] = len(self.color_ids)
+            self.color_ids.append(color_id)
+            self.prices.append(price)
+        else:
+            self.color_ids[slot] = color_id
+            self.prices[slot] = price
+
+    @classmethod
+    def load(cls, products=None):
+        # `products` optionally limits the index to a subquery of product ids
+        index = cls()
+
+        # sqlite returns the bare `price` column from the row holding MAX(created_at)
+        query = ColorPriceTrace \
+            .select(Product.zara_id, Color.zara_id, Color.id, ColorPriceTrace.price, fn.MAX(ColorPriceTrace.created_at)) \
+            .join(Color) \
+            .join(Product) \
+            .group_by(ColorPriceTrace.color) \
+            .tuples()
+        if products is not None:
+            query = query.where(Color.product.in_(products))
+
+        for product_zara_id, color_zara_id, color_id, price, _ in query.iterator():
+            index.set(product_zara_id, color_zara_id, color_id, price)
+
+        return index
+
+
+class SizeStateIndex:
+    # (color db id, zara size id) -> (size db id, last availability, last price)
+    #
+    # sizes outnumber colors about 6:1, so besides the parallel arrays the
+    # handful of availability strings are stored as one byte codes
+
+    def __init__(self):
+        self.slots = {}
+        self.size_ids = array('q')
+        self.prices = array('q')
+        self.availability_codes = array('b')
+        self.availabilities = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    key = staticmethod(ColorPriceIndex.key)
+
+    def get(self, color_id: int, size_zara_id: int):
+        slot = self.slots.get(self.key(color_id, size_zara_id))
+        if slot is None:
+            return None
+        price = self.prices[slot]
+        return self.size_ids[slot], self.availabilities[self.availability_codes[slot]], None if price == -1 else price
+
+    def set(self, color_id: int, size_zara_id: int, size_id: int, availability: str, price: int | None):
+        if availability not in self.availabilities:
+            self.availabilities.append(availability)
+        code = self.availabilities.index(availability)
+        price = -1 if price is None else price
+
+        key = self.key(color_id, size_zara_id)
+        slot = self.slots.get(key)
+        if slot is None:
+            self.slots[key] = len(self.size_ids)
+            self.size_ids.append(size_id)
+            self.availability_codes.append(code)
+            self.prices.append(price)
+        else:
+            self.size_ids[slot] = size_id
+            self.availability_codes[slot] = code
+            self.prices[slot] = price
+
+    @classmethod
+    def load(cls, products=None):
+        # `products` optionally limits the index to a subquery of product ids
+        index = cls()
+        sizes = None
+        if products is not None:
+            sizes = Size.select(Size.id).join(Color).where(Color.product.in_(products))
+
+        prices = {}
+        query = SizePriceTrace \
+            .select(SizePriceTrace.size, SizePriceTrace.price, fn.MAX(SizePriceTrace.created_at)) \
+            .group_by(SizePriceTrace.size) \
+            .tuples()
+        if sizes is not None:
+            query = query.where(SizePriceTrace.size.in_(sizes))
+        for size_id, price, _ in query.iterator():
+            prices[size_id] = price
+
+        query = SizeAvailabilityTrace \
+            .select(Size.color, Size.zara_id, Size.id, SizeAvailabilityTrace.availability, fn.MAX(SizeAvailabilityTrace.created_at)) \
+            .join(Size) \
+            .group_by(SizeAvailabilityTrace.size) \
+            .tuples()
+        if sizes is not None:
+            query = query.where(SizeAvailabilityTrace.size.in_(sizes))
+        for color_id, size_zara_id, size_id, availability, _ in query.iterator():
+            if size_id in prices:
+                index.set(color_id, size_zara_id, size_id, availability, prices[size_id])
+
+        return index
+
+
+class ColorMediaIndex:
+    # color db id -> hash of its photos (path, name and timestamp, in order)
+    #
+    # hashes are only compared within one process, a color's media is rewritten
+    # when its listing shows different photos or re-uploaded ones
+
+    def __init__(self):
+        self.signatures = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, color_id: int):
+        return color_id in self.signatures
+
+    @staticmethod
+    def signature(photos) -> int:
+        return hash(tuple(photos))
+
+    def changed(self, color_id: int, photos) -> bool:
+        return self.signatures.get(color_id) != self.signature(photos)
+
+    def set(self, color_id: int, photos):
+        self.signatures[color_id] = self.signature(photos)
+
+    @classmethod
+    def load(cls, products=None):
+        # `products` optionally limits the index to a subquery of product ids
+        index = cls()
+        query = ColorMedia \
+            .select(ColorMedia.color, Media.path, Media.name, Media.timestamp) \
+            .join(Media) \
+            .order_by(ColorMedia.color, ColorMedia.position) \
+            .tuples()
+        if products is not None:
+            query = query.join_from(ColorMedia, Color).where(Color.product.in_(products))
+
+        color_id, photos = None, []
+        for row_color_id, path, name, timestamp in query.iterator():
+            if row_color_id != color_id:
+                if photos:
+                    index.set(color_id, photos)
+                color_id, photos = row_color_id, []
+            photos.append(Photo(path, name, timestamp))
+        if photos:
+            index.set(color_id, photos)
+
+        return index
@@ -0,0 +1,89 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Process wide timings and SQL counters, published by
+# zara_tracker.extensions.InstrumentationExtension. Recording is a couple of
+# perf_counter calls and a bisect, cheap enough to stay on in production.
+
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float('inf'))
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.statements = {}  # statement type -> [count, seconds]
+
+    def observe(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def measure_iteration(self, stage, iterable, seconds=0.0):
+        # one observation of the time spent producing the items of `iterable`
+        # (plus `seconds`), recorded once it is exhausted
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.observe(stage, seconds + time.perf_counter() - started)
+                return
+            seconds += time.perf_counter() - started
+            yield item
+
+    def sql_executed(self, sql, seconds):
+        # the first word, statements may start with a newline (migrations)
+        words = sql.split(None, 1)
+        kind = words[0].lower() if words else ''
+        counter = self.statements.get(kind)
+        if counter is None:
+            counter = self.statements[kind] = [0, 0.0]
+        counter[0] += 1
+        counter[1] += seconds
+
+    def statement_count(self):
+        return sum(count for count, _ in self.statements.values())
+
+
+metrics = Metrics()
@@ -6,9 +6,126 @@
 import scrapy
 from peewee import *
 import datetime
-from zara_tracker.settings import DATABASE_FILEPATH
+import os
+import time
+from dataclasses import dataclass, field
+from typing import NamedTuple
+from urllib.parse import quote
+from zara_tracker.instrumentation import metrics
+from zara_tracker.settings import DATABASE_FILEPATH, COUNTRY_CODE, SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, \
+    SQLITE_CACHE_SIZE, SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT
+
+databases = {}
+readonly_databases = {}
+
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    # counts and times every statement by type, see zara_tracker.instrumentation
+    def execute_sql(self, sql, params=None, commit=None):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            metrics.sql_executed(sql, time.perf_counter() - started)
+
+def database_pragmas(readonly: bool = False) -> dict:
+    # applied on every new connection. With WAL readers work on a snapshot and
+    # never block the crawler's writes, synchronous=normal only fsyncs on checkpoints
+    pragmas = {
+        'cache_size': SQLITE_CACHE_SIZE,
+        'mmap_size': SQLITE_MMAP_SIZE,
+    }
+    if readonly:
+        pragmas['query_only'] = 1
+    else:
+        pragmas['journal_mode'] = SQLITE_JOURNAL_MODE
+        pragmas['synchronous'] = SQLITE_SYNCHRONOUS
+    return pragmas
+
+def database_path(country: str) -> str | None:
+    path = DATABASE_FILEPATH
+    if path and '{country}' in path:
+        path = path.format(country=country)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    elif country != COUNTRY_CODE:
+        raise ValueError(f"DATABASE_FILEPATH needs a {{country}} placeholder to store market '{country}'")
+    return path
+
+def get_database(country: str = COUNTRY_CODE, readonly: bool = False) -> SqliteDatabase:
+    # every market has its own database, DATABASE_FILEPATH may contain a {country} placeholder
+    #
+    # `readonly` returns a second handle opened with mode=ro for reports and
+    # analytics, it can't take the write lock even by accident
+    cache = readonly_databases if readonly else databases
+    if country not in cache:
+        path = database_path(country)
+        if readonly and path:
+            cache[country] = InstrumentedSqliteDatabase(
+                f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True,
+                pragmas=database_pragmas(readonly=True), timeout=SQLITE_BUSY_TIMEOUT)
+        else:
+            cache[country] = InstrumentedSqliteDatabase(path, pragmas=database_pragmas(), timeout=SQLITE_BUSY_TIMEOUT)
+    return cache[country]
+
+db = get_database()
+
+
+# Scraped items. They are created for every product, color and size of a
+# listing, so they are slotted dataclasses and photos stay (path, name, timestamp)
+# tuples until a url is needed.
+
+class Photo(NamedTuple):
+    path: str
+    name: str
+    timestamp: int
+
+    def url(self, width=750):
+        return f"https://static.zara.net/photos//{self.path}/w/{width}/{self.name}.jpg?ts={self.timestamp}"
+
+@dataclass(slots=True)
+class SizeItem:
+    id: int
+    name: str
+    availability: str
+    price: int | None
+    old_price: int | None = None
+    original_price: int | None = None
+
+@dataclass(slots=True)
+class ColorItem:
+    id: int
+    name: str
+    price: int
+    old_price: int | None = None
+    original_price: int | None = None
+    photos: tuple = ()
+    sizes: list = field(default_factory=list)
+
+@dataclass(slots=True)
+class ProductItem:
+    id: int
+    name: str
+    country: str = COUNTRY_CODE
+    market: str | None = None
+    url: str | None = None
+    category: str | None = None
+    description: str = ''
+    colors: list = field(default_factory=list)
+
+@dataclass(slots=True)
+class ProductCategoryItem:
+    # another category listing a product that was already passed on, see
+    # ProductDeduplicationMiddleware
+    country: str
+    product_id: int
+    category: str
+
+@dataclass(slots=True)
+class ListingDone:
+    # yielded after the products of a listing, the pipeline marks the listing
+    # done in the transaction that stores them
+    country: str
+    category_id: int
 
-db = SqliteDatabase(DATABASE_FILEPATH)
 
 class BaseModel(Model):
     class Meta:
@@ -16,7 +133,7 @@ class BaseModel(Model):
 
 class Product(BaseModel):
     id = AutoField()
-    zara_id = IntegerField()
+    zara_id = IntegerField(unique=True)
     market = CharField()
     name = CharField()
     category = CharField()
@@ -25,34 +142,174 @@ class Product(BaseModel):
     tracking = BooleanField(default=False)
     created_at = DateTimeField(default=datetime.datetime.now)
 
+class ProductCategory(BaseModel):
+    # every category a product is listed in, Product.category is the first one
+    product = ForeignKeyField(Product, backref='categories', index=False)
+    category = CharField()
+
+    class Meta:
+        indexes = (
+            (('product', 'category'), True),
+        )
+
 class Color(BaseModel):
     id = AutoField()
-    product = ForeignKeyField(Product, backref='colors')
+    product = ForeignKeyField(Product, backref='colors', index=False)
     zara_id = IntegerField()
     name = CharField()
-    image = TextField()
+
+    class Meta:
+        indexes = (
+            (('product', 'zara_id'), True),
+        )
+
+class Media(BaseModel):
+    # a photo, shared by every color and market showing it. Zara bumps the
+    # timestamp when it re-uploads a photo, the path and name stay
+    path = CharField()
+    name = CharField()
+    timestamp = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('path', 'name'), True),
+        )
+
+class ColorMedia(BaseModel):
+    color = ForeignKeyField(Color, backref='media', index=False)
+    media = ForeignKeyField(Media, backref='colors')
+    position = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('color', 'position')
+
+class CrawlRun(BaseModel):
+    # one crawl of a market by a spider. Readers use the latest finished run to
+    # know when their cached results are stale. A prices run that was
+    # interrupted is resumed by the next process, it is `completed_at` once all
+    # of its listings were crawled, see zara_tracker.checkpoint
+    spider = CharField()
+    started_at = DateTimeField(default=datetime.datetime.now)
+    finished_at = DateTimeField(null=True)
+    reason = CharField(null=True)
+    completed_at = DateTimeField(null=True)
+    reported_at = DateTimeField(null=True)
 
 class ColorPriceTrace(BaseModel):
-    color = ForeignKeyField(Color, backref='price_traces')
+    color = ForeignKeyField(Color, backref='price_traces', index=False)
+    run = ForeignKeyField(CrawlRun, backref='price_traces', null=True, index=False)
     price = IntegerField()
     old_price = IntegerField(null=True)
     original_price = IntegerField(null=True)
-    created_at = DateTimeField(default=datetime.datetime.now)
+    created_at = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        indexes = (
+            (('color', 'created_at'), False),
+        )
 
 class Size(BaseModel):
     id = AutoField()
-    color = ForeignKeyField(Color, backref='sizes')
+    color = ForeignKeyField(Color, backref='sizes', index=False)
     zara_id = IntegerField()
     name = CharField()
 
+    class Meta:
+        indexes = (
+            (('color', 'zara_id'), True),
+        )
+
 class SizeAvailabilityTrace(BaseModel):
-    size = ForeignKeyField(Size, backref='availability_traces')
+    size = ForeignKeyField(Size, backref='availability_traces', index=False)
     availability = CharField()
     created_at = DateTimeField(default=datetime.datetime.now)
 
+    class Meta:
+        indexes = (
+            (('size', 'created_at'), False),
+        )
+
 class SizePriceTrace(BaseModel):
-    size = ForeignKeyField(Size, backref='price_traces')
+    size = ForeignKeyField(Size, backref='price_traces', index=False)
     price = IntegerField()
     old_price = IntegerField(null=True)
     original_price = IntegerField(null=True)
     created_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('size', 'created_at'), False),
+        )
+
+
+class Notification(BaseModel):
+    product = ForeignKeyField(Product, backref='notifications', index=False)
+    kind = CharField(default='discount')
+    date = DateField(default=datetime.date.today)
+    market = CharField()
+    images = TextField()
+    message = TextField()
+    attempts = IntegerField(default=0)
+    error = TextField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.now)
+    sent_at = DateTimeField(null=True, index=True)
+
+    class Meta:
+        indexes = (
+            (('product', 'kind', 'date'), True),
+        )
+
+class HttpCacheEntry(BaseModel):
+    url = TextField(unique=True)
+    etag = TextField(null=True)
+    last_modified = TextField(null=True)
+    content_hash = CharField()
+    updated_at = DateTimeField(default=datetime.datetime.now)
+
+class DailyPriceChange(BaseModel):
+    # last price change of a color per day next to the price it replaced,
+    # maintained by the pipeline so reports are a range read on (date, percent)
+    color = ForeignKeyField(Color, backref='daily_price_changes', index=False)
+    product = ForeignKeyField(Product, backref='daily_price_changes', index=False)
+    market = CharField(null=True)
+    date = DateField(default=datetime.date.today)
+    previous_price = IntegerField()
+    price = IntegerField()
+    percent = FloatField()  # negative for drops
+    changed_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('color', 'date'), True),
+            (('date', 'percent'), False),
+        )
+
+class CategorySchedule(BaseModel):
+    # a leaf category of the resolved category tree and when to crawl it next.
+    # `change_rate` is the smoothed share of visits that found changed prices
+    category_id = IntegerField(unique=True)
+    market = CharField()
+    name = CharField()
+    refreshed_at = DateTimeField(default=datetime.datetime.now)
+    change_rate = FloatField(default=1.0)
+    priority = IntegerField(default=0)
+    revisit_interval = FloatField(default=0)  # seconds
+    price_hash = CharField(null=True)
+    last_crawled_at = DateTimeField(null=True)
+    next_crawl_at = DateTimeField(null=True, index=True)
+
+class CrawlListing(BaseModel):
+    # a category listing planned by a run, `done_at` is committed together
+    # with the last products of the listing
+    run = ForeignKeyField(CrawlRun, backref='listings', index=False)
+    category_id = IntegerField()
+    market = CharField()
+    name = CharField()
+    done_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('run', 'category_id'), True),
+        )
+
+MODELS = [Product, ProductCategory, Color, Media, ColorMedia, ColorPriceTrace, Size, SizeAvailabilityTrace, SizePriceTrace, Notification, HttpCacheEntry, CrawlRun, CrawlListing, DailyPriceChange, CategorySchedule]
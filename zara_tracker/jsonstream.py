@@ -0,0 +1,87 @@
+import json
+import re
+
+decoder = json.JSONDecoder()
+whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def find_path(text: str, path: tuple, pos: int = 0):
+    # position of the value at `path` (keys and list indexes) within the value
+    # starting at `pos`, None if it is missing
+    pos = skip_whitespace(text, pos)
+    for step in path:
+        pos = find_index(text, pos, step) if isinstance(step, int) else find_key(text, pos, step)
+        if pos is None:
+            return None
+    return pos
+
+
+def iter_json_array(text: str, path: tuple, pos: int = 0):
+    # Yields the items of the array found at `path` (keys and list indexes,
+    # e.g. ('productGroups', 0, 'elements')) one at a time. Only the items
+    # and the values on the way to the array are decoded, everything after
+    # the array is never parsed.
+    pos = find_path(text, path, pos)
+    if pos is None or text[pos] != '[':
+        return
+
+    pos = skip_whitespace(text, pos + 1)
+    if text[pos] == ']':
+        return
+
+    while True:
+        item, pos = decoder.raw_decode(text, pos)
+        yield item
+
+        pos = skip_whitespace(text, pos)
+        if text[pos] == ']':
+            return
+        pos = expect(text, pos, ',')
+
+
+def find_key(text: str, pos: int, key: str):
+    if text[pos] != '{':
+        return None
+
+    pos = skip_whitespace(text, pos + 1)
+    if text[pos] == '}':
+        return None
+
+    while True:
+        name, pos = decoder.raw_decode(text, pos)
+        pos = expect(text, skip_whitespace(text, pos), ':')
+        if name == key:
+            return pos
+
+        _, pos = decoder.raw_decode(text, pos)
+        pos = skip_whitespace(text, pos)
+        if text[pos] == '}':
+            return None
+        pos = expect(text, pos, ',')
+
+
+def find_index(text: str, pos: int, index: int):
+    if text[pos] != '[':
+        return None
+
+    pos = skip_whitespace(text, pos + 1)
+    if text[pos] == ']':
+        return None
+
+    for _ in range(index):
+        _, pos = decoder.raw_decode(text, pos)
+        pos = skip_whitespace(text, pos)
+        if text[pos] == ']':
+            return None
+        pos = expect(text, pos, ',')
+    return pos
+
+
+def skip_whitespace(text: str, pos: int) -> int:
+    return whitespace.match(text, pos).end()
+
+
+def expect(text: str, pos: int, char: str) -> int:
+    if text[pos:pos + 1] != char:
+        raise json.JSONDecodeError(f"Expecting '{char}'", text, pos)
+    return skip_whitespace(text, pos + 1)
@@ -0,0 +1,10 @@
+def parse_markets(value: str) -> list:
+    # "pl:pl,nl:nl" -> [("pl", "pl"), ("nl", "nl")], the language defaults to the country code
+    markets = []
+    for market in value.split(','):
+        market = market.strip().lower()
+        if not market:
+            continue
+        country, _, language = market.partition(':')
+        markets.append((country, language or country))
+    return markets
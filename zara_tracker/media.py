@@ -0,0 +1,83 @@
+import logging
+import re
+
+from peewee import fn, chunked, EXCLUDED
+from zara_tracker.items import Photo, Media, ColorMedia
+
+# Color photos are stored once per (path, name) in Media, ColorMedia keeps the
+# order they are shown in. Urls are only built when a notification or the api
+# needs them, see Photo.url.
+
+PHOTO_URL = re.compile(r"https://static\.zara\.net/photos//(?P<path>.+)/w/\d+/(?P<name>[^/]+)\.jpg\?ts=(?P<timestamp>\d+)")
+
+
+def parse_photo_url(url: str) -> Photo | None:
+    match = PHOTO_URL.fullmatch(url.strip())
+    if match is None:
+        return None
+    return Photo(match['path'], match['name'], int(match['timestamp']))
+
+
+def store_color_media(colors: dict, replace=True):
+    # color db id -> photos, replaces the media of these colors (pass
+    # replace=False for new ones). Known photos only get their timestamp
+    # bumped, a stale listing never moves it back
+    timestamps = {}
+    for photos in colors.values():
+        for photo in photos:
+            key = (photo.path, photo.name)
+            timestamps[key] = max(photo.timestamp, timestamps.get(key, 0))
+
+    rows = [{'path': path, 'name': name, 'timestamp': timestamp} for (path, name), timestamp in timestamps.items()]
+    for chunk in chunked(rows, 300):
+        Media.insert_many(chunk).on_conflict(
+            conflict_target=[Media.path, Media.name],
+            update={Media.timestamp: fn.MAX(Media.timestamp, EXCLUDED.timestamp)},
+        ).execute()
+    media_ids = select_media_ids(timestamps.keys())
+
+    if replace:
+        for ids in chunked(list(colors), 500):
+            ColorMedia.delete().where(ColorMedia.color.in_(ids)).execute()
+
+    rows = [{
+        'color': color_id,
+        'media': media_ids[(photo.path, photo.name)],
+        'position': position,
+    } for color_id, photos in colors.items() for position, photo in enumerate(photos)]
+    for chunk in chunked(rows, 300):
+        ColorMedia.insert_many(chunk).execute()
+
+    logging.debug(f"Stored {len(timestamps)} photos of {len(colors)} colors")
+
+
+def select_media_ids(keys):
+    # (path, name) -> media id; paths are selected in bulk, names matched here
+    keys = set(keys)
+    media_ids = {}
+    for paths in chunked({path for path, _ in keys}, 500):
+        query = Media.select(Media.id, Media.path, Media.name).where(Media.path.in_(paths)).tuples()
+        for media_id, path, name in query:
+            if (path, name) in keys:
+                media_ids[(path, name)] = media_id
+    return media_ids
+
+
+def color_photos(color_ids) -> dict:
+    # color db id -> photos in the order they are shown
+    photos = {}
+    for ids in chunked(list(color_ids), 500):
+        query = ColorMedia \
+            .select(ColorMedia.color, Media.path, Media.name, Media.timestamp) \
+            .join(Media) \
+            .where(ColorMedia.color.in_(ids)) \
+            .order_by(ColorMedia.color, ColorMedia.position) \
+            .tuples()
+        for color_id, path, name, timestamp in query:
+            photos.setdefault(color_id, []).append(Photo(path, name, timestamp))
+    return photos
+
+
+def color_images(color_ids, width=750) -> dict:
+    # color db id -> photo urls
+    return {color_id: [photo.url(width) for photo in photos] for color_id, photos in color_photos(color_ids).items()}
@@ -3,11 +3,23 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import datetime
+import hashlib
+import time
+from urllib.parse import urlparse
+
+from peewee import chunked
 from scrapy import signals
+from scrapy.exceptions import NotConfigured, IgnoreRequest
+from twisted.internet.error import TimeoutError, TCPTimedOutError, ConnectionRefusedError, ConnectionLost
+from twisted.web.client import ResponseFailed
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from zara_tracker.items import HttpCacheEntry, ProductCategoryItem, get_database
+from zara_tracker.settings import COUNTRY_CODE
+
 
 class ZaraTrackerSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -56,6 +68,72 @@ class ZaraTrackerSpiderMiddleware:
         spider.logger.info("Spider opened: %s" % spider.name)
 
 
+class ProductDeduplicationMiddleware:
+    # The same product is listed in many categories ("new in", "view all", ...).
+    # Only the first copy of a product is passed on, later copies with the same
+    # content are dropped here. A copy from a category the product wasn't seen
+    # in yet is replaced by a ProductCategoryItem, the pipeline stores it as a
+    # ProductCategory row.
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.fingerprints = {}
+        self.categories = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        for i in result:
+            i = self.deduplicate(i)
+            if i is not None:
+                yield i
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for i in result:
+            i = self.deduplicate(i)
+            if i is not None:
+                yield i
+
+    def deduplicate(self, item):
+        # -> the item, a ProductCategoryItem in its place or None
+        if not is_item(item) or isinstance(item, ProductCategoryItem):
+            return item
+
+        adapter = ItemAdapter(item)
+        if adapter.get("id") is None:
+            return item
+        product_id = (adapter.get("country"), adapter.get("id"))
+
+        categories = self.categories.setdefault(product_id, set())
+        category = adapter.get("category")
+        new_category = category is not None and category not in categories
+        if new_category:
+            categories.add(category)
+
+        fingerprint = self.fingerprint(adapter)
+        if self.fingerprints.get(product_id) == fingerprint:
+            self.stats.inc_value("dedup/dropped")
+            if new_category:
+                return ProductCategoryItem(adapter.get("country"), adapter.get("id"), category)
+            return None
+
+        # first copy or the content changed mid-crawl, pass it on
+        self.fingerprints[product_id] = fingerprint
+        self.stats.inc_value("dedup/passed")
+        return item
+
+    def fingerprint(self, adapter):
+        return hash((adapter.get("name"), tuple(
+            (
+                c.id, c.price, c.old_price, c.original_price, c.photos,
+                tuple((s.id, s.availability, s.price) for s in c.sizes),
+            )
+            for c in adapter.get("colors", [])
+        )))
+
+
 class ZaraTrackerDownloaderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
@@ -101,3 +179,273 @@ class ZaraTrackerDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class ConditionalRequestMiddleware:
+    # Sends If-None-Match / If-Modified-Since for requests with meta["conditional"]
+    # and flags responses that did not change since the last finished crawl with
+    # meta["unchanged"], either because the server answered 304 or because the
+    # body hashes to the same value. Validators are only persisted when the crawl
+    # finishes, so an interrupted run never hides listings that weren't stored.
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.entries = {}
+        self.updates = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("CONDITIONAL_REQUESTS_ENABLED"):
+            raise NotConfigured
+        s = cls(crawler.stats)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if not request.meta.get("conditional"):
+            return None
+
+        # requests come back here on retries and refetches
+        statuses = request.meta.get("handle_httpstatus_list", [])
+        if 304 not in statuses:
+            request.meta["handle_httpstatus_list"] = [*statuses, 304]
+
+        entry = self.entries.get(request.url)
+        if entry:
+            etag, last_modified, _ = entry
+            if etag:
+                request.headers.setdefault("If-None-Match", etag)
+            if last_modified:
+                request.headers.setdefault("If-Modified-Since", last_modified)
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get("conditional"):
+            return response
+
+        entry = self.entries.get(request.url)
+        if response.status == 304 and entry:
+            self.stats.inc_value("conditional/not_modified")
+            request.meta["unchanged"] = True
+            return response
+
+        if response.status == 304:
+            # no stored listing to fall back on, ask for the full one once
+            if request.meta.get("conditional_retry"):
+                spider.logger.warning(f"Got 304 for {request.url} without a cached listing, ignoring it")
+                raise IgnoreRequest(f"304 without a cached listing: {request.url}")
+            self.stats.inc_value("conditional/refetched")
+            retry = request.replace(dont_filter=True)
+            for name in (b"If-None-Match", b"If-Modified-Since"):
+                retry.headers.pop(name, None)
+            retry.meta["conditional_retry"] = True
+            return retry
+
+        if response.status != 200:
+            return response
+
+        content_hash = hashlib.blake2b(response.body, digest_size=16).hexdigest()
+        if entry and entry[2] == content_hash:
+            self.stats.inc_value("conditional/same_content")
+            request.meta["unchanged"] = True
+        else:
+            self.stats.inc_value("conditional/changed")
+
+        country = request.cb_kwargs.get("country", COUNTRY_CODE)
+        self.updates.setdefault(country, {})[request.url] = (
+            self.header(response, b"ETag"),
+            self.header(response, b"Last-Modified"),
+            content_hash,
+        )
+        return response
+
+    def header(self, response, name):
+        value = response.headers.get(name)
+        return value.decode("latin-1") if value else None
+
+    def spider_opened(self, spider):
+        # urls contain the market, so validators of all markets share one map
+        for country in getattr(spider, "countries", [COUNTRY_CODE]):
+            reader = get_database(country, readonly=True)
+            with reader.bind_ctx([HttpCacheEntry]), reader.connection_context():
+                self.entries.update({
+                    url: (etag, last_modified, content_hash)
+                    for url, etag, last_modified, content_hash in HttpCacheEntry
+                        .select(HttpCacheEntry.url, HttpCacheEntry.etag, HttpCacheEntry.last_modified, HttpCacheEntry.content_hash)
+                        .tuples()
+                })
+        spider.logger.info(f"Loaded {len(self.entries)} cached validators")
+
+    def spider_closed(self, spider, reason):
+        if reason != "finished":
+            spider.logger.info(f"Crawl {reason}, not storing {sum(map(len, self.updates.values()))} validators")
+            return
+
+        now = datetime.datetime.now()
+        for country, updates in self.updates.items():
+            rows = [{
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "content_hash": content_hash,
+                "updated_at": now,
+            } for url, (etag, last_modified, content_hash) in updates.items()]
+
+            database = get_database(country)
+            with database.bind_ctx([HttpCacheEntry]), database.connection_context(), database.atomic():
+                for chunk in chunked(rows, 100):
+                    HttpCacheEntry.insert_many(chunk).on_conflict(
+                        conflict_target=[HttpCacheEntry.url],
+                        preserve=[HttpCacheEntry.etag, HttpCacheEntry.last_modified, HttpCacheEntry.content_hash, HttpCacheEntry.updated_at],
+                    ).execute()
+
+
+class EndpointThrottle:
+    # AIMD state of one endpoint class: concurrency grows by one per window of
+    # successful responses and is halved (delay doubled) when zara pushes back
+
+    def __init__(self, name, max_concurrency, start_concurrency, min_delay, max_delay):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(min(start_concurrency, max_concurrency))
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.latency = None
+        self.backed_off_at = 0
+
+    def on_success(self, latency, target_latency):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.latency > target_latency:
+            # server is slowing down, hold the current rate
+            return
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        self.delay = max(self.min_delay, self.delay * 0.9 - 0.01)
+
+    def on_throttle(self, retry_after=None):
+        # responses of requests sent before the last decrease don't count again
+        now = time.monotonic()
+        if now - self.backed_off_at < (self.latency or 1):
+            return False
+        self.backed_off_at = now
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.delay = min(self.max_delay, max(self.delay * 2, 0.25, retry_after or 0))
+        return True
+
+
+class AdaptiveThrottleMiddleware:
+    # Replaces AutoThrottle with one download slot per endpoint class, so a
+    # soft block on the listing endpoint doesn't slow down the categories call
+    # and the other way round. Each slot's concurrency and delay follow an
+    # AIMD controller fed by latency and 429/403/5xx/timeout signals; the
+    # current state is kept in the crawl stats under throttle/<endpoint>/.
+
+    THROTTLE_STATUSES = {403, 429, 503}
+    ERROR_EXCEPTIONS = (TimeoutError, TCPTimedOutError, ConnectionRefusedError, ConnectionLost, ResponseFailed)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.target_latency = settings.getfloat("ADAPTIVE_THROTTLE_TARGET_LATENCY")
+        self.throttles = {
+            name: EndpointThrottle(
+                name,
+                max_concurrency,
+                settings.getint("ADAPTIVE_THROTTLE_START_CONCURRENCY"),
+                settings.getfloat("ADAPTIVE_THROTTLE_MIN_DELAY"),
+                settings.getfloat("ADAPTIVE_THROTTLE_MAX_DELAY"),
+            )
+            for name, max_concurrency in settings.getdict("ADAPTIVE_THROTTLE_MAX_CONCURRENCY").items()
+        }
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ADAPTIVE_THROTTLE_ENABLED"):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def endpoint(self, request):
+        url = urlparse(request.url)
+        if url.hostname != "www.zara.com":
+            return "static"
+        if url.path.endswith("/categories"):
+            return "categories"
+        if "/category/" in url.path and url.path.endswith("/products"):
+            return "listing"
+        return "product"
+
+    def process_request(self, request, spider):
+        if "download_slot" not in request.meta:
+            request.meta["download_slot"] = f"zara-{self.endpoint(request)}"
+        return None
+
+    def process_response(self, request, response, spider):
+        throttle = self.throttle(request)
+        if throttle is None:
+            return response
+
+        self.stats.inc_value(f"throttle/{throttle.name}/responses")
+        if response.status in self.THROTTLE_STATUSES:
+            self.stats.inc_value(f"throttle/{throttle.name}/throttled")
+            self.back_off(request, throttle, self.retry_after(response))
+        elif response.status >= 500:
+            self.stats.inc_value(f"throttle/{throttle.name}/errors")
+            self.back_off(request, throttle)
+        elif "download_latency" in request.meta:
+            throttle.on_success(request.meta["download_latency"], self.target_latency)
+            self.apply(request, throttle)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        throttle = self.throttle(request)
+        if throttle is not None and isinstance(exception, self.ERROR_EXCEPTIONS):
+            self.stats.inc_value(f"throttle/{throttle.name}/errors")
+            self.back_off(request, throttle)
+        return None
+
+    def throttle(self, request):
+        slot = request.meta.get("download_slot", "")
+        return self.throttles.get(slot.removeprefix("zara-"))
+
+    def back_off(self, request, throttle, retry_after=None):
+        if throttle.on_throttle(retry_after):
+            self.crawler.spider.logger.info(
+                f"Throttling {throttle.name}: concurrency {int(throttle.concurrency)}, delay {throttle.delay:.2f}s"
+            )
+        self.apply(request, throttle)
+
+    def apply(self, request, throttle):
+        slot = self.crawler.engine.downloader.slots.get(request.meta["download_slot"])
+        if slot is not None:
+            slot.concurrency = int(throttle.concurrency)
+            slot.delay = throttle.delay
+
+        self.stats.set_value(f"throttle/{throttle.name}/concurrency", int(throttle.concurrency))
+        self.stats.set_value(f"throttle/{throttle.name}/delay", round(throttle.delay, 3))
+        if throttle.latency is not None:
+            self.stats.set_value(f"throttle/{throttle.name}/latency", round(throttle.latency, 3))
+
+    def retry_after(self, response):
+        value = response.headers.get(b"Retry-After")
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    def spider_opened(self, spider):
+        # the slots are created on their first request with the per slot
+        # settings (DOWNLOAD_SLOTS), start them at the throttle's state instead
+        # of CONCURRENT_REQUESTS_PER_DOMAIN
+        per_slot_settings = self.crawler.engine.downloader.per_slot_settings
+        for throttle in self.throttles.values():
+            per_slot_settings[f"zara-{throttle.name}"] = {
+                **per_slot_settings.get(f"zara-{throttle.name}", {}),
+                "concurrency": int(throttle.concurrency),
+                "delay": throttle.delay,
+            }
+            self.stats.set_value(f"throttle/{throttle.name}/concurrency", int(throttle.concurrency))
+            self.stats.set_value(f"throttle/{throttle.name}/delay", throttle.delay)
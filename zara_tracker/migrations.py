@@ -0,0 +1,246 @@
+import logging
+
+from zara_tracker.items import Product, MODELS
+from zara_tracker.media import parse_photo_url, store_color_media
+
+# Each migration upgrades the schema by one version, the current version is
+# stored in sqlite's `PRAGMA user_version`. Only ever append to this list.
+#
+# Migrations spell out the DDL of the version they were written for, the
+# models only describe the latest one.
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def migrate(database):
+    with database.bind_ctx(MODELS):
+        run_migrations(database)
+
+
+def run_migrations(database):
+    version = get_version(database)
+
+    if version == 0 and not database.table_exists(Product._meta.table_name):
+        logging.info(f"Creating database schema version {len(MIGRATIONS)}")
+        with database.atomic():
+            database.create_tables(MODELS)
+            set_version(database, len(MIGRATIONS))
+        return
+
+    for number, func in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Migrating database to version {number}: {func.__name__}")
+        with database.atomic():
+            func(database)
+            set_version(database, number)
+
+
+def get_version(database):
+    return database.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_version(database, version: int):
+    database.execute_sql(f'PRAGMA user_version = {int(version)}')
+
+
+def execute_statements(database, statements: list):
+    for sql in statements:
+        database.execute_sql(sql)
+
+
+def merge_duplicates(database, table: str, key_columns: list, references: list):
+    # keep the lowest id for every natural key and point references (table, column) at it
+    database.execute_sql('DROP TABLE IF EXISTS temp.duplicates')
+    database.execute_sql('CREATE TEMP TABLE duplicates (id INTEGER PRIMARY KEY, keep_id INTEGER NOT NULL)')
+    database.execute_sql(f"""
+        INSERT INTO temp.duplicates (id, keep_id)
+        SELECT id, keep_id FROM (
+            SELECT id, MIN(id) OVER (PARTITION BY {', '.join(key_columns)}) AS keep_id FROM {table}
+        )
+        WHERE id != keep_id
+    """)
+
+    for ref_table, ref_column in references:
+        database.execute_sql(f"""
+            UPDATE {ref_table}
+            SET {ref_column} = (SELECT keep_id FROM temp.duplicates WHERE id = {ref_table}.{ref_column})
+            WHERE {ref_column} IN (SELECT id FROM temp.duplicates)
+        """)
+
+    cursor = database.execute_sql(f'DELETE FROM {table} WHERE id IN (SELECT id FROM temp.duplicates)')
+    if cursor.rowcount:
+        logging.info(f"Merged {cursor.rowcount} duplicate rows in {table}")
+    database.execute_sql('DROP TABLE temp.duplicates')
+
+
+@migration
+def create_missing_tables(database):
+    # the tables of the first schema
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "product" ("id" INTEGER NOT NULL PRIMARY KEY, "zara_id" INTEGER NOT NULL, "market" VARCHAR(255) NOT NULL, '
+        '"name" VARCHAR(255) NOT NULL, "category" VARCHAR(255) NOT NULL, "description" TEXT NOT NULL, "url" TEXT NOT NULL, '
+        '"tracking" INTEGER NOT NULL, "created_at" DATETIME NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS "color" ("id" INTEGER NOT NULL PRIMARY KEY, "product_id" INTEGER NOT NULL, "zara_id" INTEGER NOT NULL, '
+        '"name" VARCHAR(255) NOT NULL, "image" TEXT NOT NULL, FOREIGN KEY ("product_id") REFERENCES "product" ("id"))',
+        'CREATE TABLE IF NOT EXISTS "colorpricetrace" ("id" INTEGER NOT NULL PRIMARY KEY, "color_id" INTEGER NOT NULL, "price" INTEGER NOT NULL, '
+        '"old_price" INTEGER, "original_price" INTEGER, "created_at" DATETIME NOT NULL, FOREIGN KEY ("color_id") REFERENCES "color" ("id"))',
+        'CREATE TABLE IF NOT EXISTS "size" ("id" INTEGER NOT NULL PRIMARY KEY, "color_id" INTEGER NOT NULL, "zara_id" INTEGER NOT NULL, '
+        '"name" VARCHAR(255) NOT NULL, FOREIGN KEY ("color_id") REFERENCES "color" ("id"))',
+        'CREATE TABLE IF NOT EXISTS "sizeavailabilitytrace" ("id" INTEGER NOT NULL PRIMARY KEY, "size_id" INTEGER NOT NULL, '
+        '"availability" VARCHAR(255) NOT NULL, "created_at" DATETIME NOT NULL, FOREIGN KEY ("size_id") REFERENCES "size" ("id"))',
+        'CREATE TABLE IF NOT EXISTS "sizepricetrace" ("id" INTEGER NOT NULL PRIMARY KEY, "size_id" INTEGER NOT NULL, "price" INTEGER NOT NULL, '
+        '"old_price" INTEGER, "original_price" INTEGER, "created_at" DATETIME NOT NULL, FOREIGN KEY ("size_id") REFERENCES "size" ("id"))',
+    ])
+
+
+@migration
+def add_natural_key_indexes(database):
+    merge_duplicates(database, 'product', ['zara_id'], [('color', 'product_id')])
+    merge_duplicates(database, 'color', ['product_id', 'zara_id'], [('colorpricetrace', 'color_id'), ('size', 'color_id')])
+    merge_duplicates(database, 'size', ['color_id', 'zara_id'], [('sizeavailabilitytrace', 'size_id'), ('sizepricetrace', 'size_id')])
+
+    # replaced by the composite indexes below
+    for index in ['color_product_id', 'colorpricetrace_color_id', 'size_color_id', 'sizeavailabilitytrace_size_id', 'sizepricetrace_size_id']:
+        database.execute_sql(f'DROP INDEX IF EXISTS {index}')
+
+    execute_statements(database, [
+        'CREATE UNIQUE INDEX IF NOT EXISTS "product_zara_id" ON "product" ("zara_id")',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "color_product_id_zara_id" ON "color" ("product_id", "zara_id")',
+        'CREATE INDEX IF NOT EXISTS "colorpricetrace_created_at" ON "colorpricetrace" ("created_at")',
+        'CREATE INDEX IF NOT EXISTS "colorpricetrace_color_id_created_at" ON "colorpricetrace" ("color_id", "created_at")',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "size_color_id_zara_id" ON "size" ("color_id", "zara_id")',
+        'CREATE INDEX IF NOT EXISTS "sizeavailabilitytrace_size_id_created_at" ON "sizeavailabilitytrace" ("size_id", "created_at")',
+        'CREATE INDEX IF NOT EXISTS "sizepricetrace_size_id_created_at" ON "sizepricetrace" ("size_id", "created_at")',
+    ])
+
+
+@migration
+def add_notification_outbox(database):
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "notification" ("id" INTEGER NOT NULL PRIMARY KEY, "product_id" INTEGER NOT NULL, '
+        '"kind" VARCHAR(255) NOT NULL, "date" DATE NOT NULL, "market" VARCHAR(255) NOT NULL, "images" TEXT NOT NULL, '
+        '"message" TEXT NOT NULL, "attempts" INTEGER NOT NULL, "error" TEXT, "created_at" DATETIME NOT NULL, "sent_at" DATETIME, '
+        'FOREIGN KEY ("product_id") REFERENCES "product" ("id"))',
+        'CREATE INDEX IF NOT EXISTS "notification_sent_at" ON "notification" ("sent_at")',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "notification_product_id_kind_date" ON "notification" ("product_id", "kind", "date")',
+    ])
+
+
+@migration
+def add_http_cache(database):
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "httpcacheentry" ("id" INTEGER NOT NULL PRIMARY KEY, "url" TEXT NOT NULL, "etag" TEXT, '
+        '"last_modified" TEXT, "content_hash" VARCHAR(255) NOT NULL, "updated_at" DATETIME NOT NULL)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "httpcacheentry_url" ON "httpcacheentry" ("url")',
+    ])
+
+
+@migration
+def add_crawl_runs(database):
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "crawlrun" ("id" INTEGER NOT NULL PRIMARY KEY, "spider" VARCHAR(255) NOT NULL, '
+        '"started_at" DATETIME NOT NULL, "finished_at" DATETIME, "reason" VARCHAR(255))',
+    ])
+
+
+@migration
+def add_daily_price_changes(database):
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "dailypricechange" ("id" INTEGER NOT NULL PRIMARY KEY, "color_id" INTEGER NOT NULL, '
+        '"product_id" INTEGER NOT NULL, "market" VARCHAR(255), "date" DATE NOT NULL, "previous_price" INTEGER NOT NULL, '
+        '"price" INTEGER NOT NULL, "percent" REAL NOT NULL, "changed_at" DATETIME NOT NULL, '
+        'FOREIGN KEY ("color_id") REFERENCES "color" ("id"), FOREIGN KEY ("product_id") REFERENCES "product" ("id"))',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "dailypricechange_color_id_date" ON "dailypricechange" ("color_id", "date")',
+        'CREATE INDEX IF NOT EXISTS "dailypricechange_date_percent" ON "dailypricechange" ("date", "percent")',
+    ])
+
+    # backfill from the traces still in the database, per color and day the
+    # last trace next to the one before it (which may be from an earlier day)
+    database.execute_sql("""
+        INSERT INTO dailypricechange (color_id, product_id, market, date, previous_price, price, percent, changed_at)
+        SELECT color.id, color.product_id, product.market, date(changes.created_at), changes.previous_price, changes.price,
+               (changes.price - changes.previous_price) * 100.0 / changes.previous_price, changes.created_at
+        FROM (
+            SELECT color_id, price, created_at,
+                   LAG(price) OVER (PARTITION BY color_id ORDER BY created_at) AS previous_price,
+                   ROW_NUMBER() OVER (PARTITION BY color_id, date(created_at) ORDER BY created_at DESC) AS position
+            FROM colorpricetrace
+        ) AS changes
+        JOIN color ON color.id = changes.color_id
+        JOIN product ON product.id = color.product_id
+        WHERE changes.position = 1 AND changes.previous_price IS NOT NULL AND changes.previous_price != 0
+    """)
+
+
+@migration
+def add_category_schedule(database):
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "categoryschedule" ("id" INTEGER NOT NULL PRIMARY KEY, "category_id" INTEGER NOT NULL, '
+        '"market" VARCHAR(255) NOT NULL, "name" VARCHAR(255) NOT NULL, "refreshed_at" DATETIME NOT NULL, "change_rate" REAL NOT NULL, '
+        '"priority" INTEGER NOT NULL, "revisit_interval" REAL NOT NULL, "price_hash" VARCHAR(255), "last_crawled_at" DATETIME, '
+        '"next_crawl_at" DATETIME)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "categoryschedule_category_id" ON "categoryschedule" ("category_id")',
+        'CREATE INDEX IF NOT EXISTS "categoryschedule_next_crawl_at" ON "categoryschedule" ("next_crawl_at")',
+    ])
+
+
+@migration
+def normalize_color_media(database):
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "media" ("id" INTEGER NOT NULL PRIMARY KEY, "path" VARCHAR(255) NOT NULL, '
+        '"name" VARCHAR(255) NOT NULL, "timestamp" INTEGER NOT NULL)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "media_path_name" ON "media" ("path", "name")',
+        'CREATE TABLE IF NOT EXISTS "colormedia" ("color_id" INTEGER NOT NULL, "media_id" INTEGER NOT NULL, "position" INTEGER NOT NULL, '
+        'PRIMARY KEY ("color_id", "position"), FOREIGN KEY ("color_id") REFERENCES "color" ("id"), '
+        'FOREIGN KEY ("media_id") REFERENCES "media" ("id"))',
+        'CREATE INDEX IF NOT EXISTS "colormedia_media_id" ON "colormedia" ("media_id")',
+    ])
+
+    # Color.image held the comma joined photo urls of a color
+    colors = {}
+    skipped = 0
+    for color_id, image in database.execute_sql('SELECT id, image FROM color WHERE image IS NOT NULL'):
+        photos = [parse_photo_url(url) for url in image.split(', ') if url]
+        skipped += photos.count(None)
+        photos = [photo for photo in photos if photo is not None]
+        if photos:
+            colors[color_id] = photos
+        if len(colors) >= 5000:
+            store_color_media(colors)
+            colors = {}
+    if colors:
+        store_color_media(colors)
+    if skipped:
+        logging.warning(f"Skipped {skipped} photo urls that couldn't be parsed")
+
+    # the freed pages are reused, only a VACUUM gives them back to the filesystem
+    database.execute_sql('ALTER TABLE color DROP COLUMN image')
+
+
+@migration
+def add_crawl_checkpoints(database):
+    database.execute_sql('ALTER TABLE crawlrun ADD COLUMN completed_at DATETIME')
+    database.execute_sql('ALTER TABLE crawlrun ADD COLUMN reported_at DATETIME')
+    database.execute_sql('ALTER TABLE colorpricetrace ADD COLUMN run_id INTEGER REFERENCES crawlrun (id)')
+    # earlier runs are never resumed nor reported again
+    database.execute_sql('UPDATE crawlrun SET completed_at = COALESCE(finished_at, started_at), reported_at = COALESCE(finished_at, started_at)')
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "crawllisting" ("id" INTEGER NOT NULL PRIMARY KEY, "run_id" INTEGER NOT NULL, '
+        '"category_id" INTEGER NOT NULL, "market" VARCHAR(255) NOT NULL, "name" VARCHAR(255) NOT NULL, "done_at" DATETIME, '
+        'FOREIGN KEY ("run_id") REFERENCES "crawlrun" ("id"))',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "crawllisting_run_id_category_id" ON "crawllisting" ("run_id", "category_id")',
+    ])
+
+
+@migration
+def add_product_categories(database):
+    execute_statements(database, [
+        'CREATE TABLE IF NOT EXISTS "productcategory" ("id" INTEGER NOT NULL PRIMARY KEY, "product_id" INTEGER NOT NULL, '
+        '"category" VARCHAR(255) NOT NULL, FOREIGN KEY ("product_id") REFERENCES "product" ("id"))',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "productcategory_product_id_category" ON "productcategory" ("product_id", "category")',
+        # the category each product was first seen in
+        'INSERT OR IGNORE INTO productcategory (product_id, category) SELECT id, category FROM product',
+    ])
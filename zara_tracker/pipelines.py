@@ -6,93 +6,461 @@
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter, is_item
-from zara_tracker.items import Product, Color, ColorPriceTrace, Size, SizeAvailabilityTrace, SizePriceTrace, db
+from zara_tracker.items import Product, ProductCategory, Color, ColorPriceTrace, Size, SizeAvailabilityTrace, SizePriceTrace, \
+    Notification, DailyPriceChange, ListingDone, ProductCategoryItem, MODELS, get_database
+from zara_tracker.checkpoint import current_run, mark_listings_done, finish_run
+from zara_tracker.index import ColorPriceIndex, ColorMediaIndex, SizeStateIndex
+from zara_tracker.instrumentation import metrics
+from zara_tracker.media import store_color_media, color_images
+from zara_tracker.migrations import migrate
+from zara_tracker.settings import COUNTRY_CODE
+from scrapy import signals
 from scrapy.exceptions import DropItem
+from twisted.internet import task
 
+import datetime
 import logging
 from peewee import *
 
+IN_STOCK = {'in_stock', 'low_on_stock'}
+
 class ZaraTrackerPipeline:
-    def __init__(self):
-        db.connect()
-        db.create_tables([Product, Color, ColorPriceTrace, Size, SizeAvailabilityTrace, SizePriceTrace])
+    def __init__(self, batch_size=500, batch_interval=5.0, track_sizes=False, restock_watch=False):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.track_sizes = track_sizes
+        self.restock_watch = restock_watch
+        self.writers = {}
+        self.flush_loop = None
+        self.spider_name = None
+        self.resume = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(
+            batch_size = crawler.settings.getint('PIPELINE_BATCH_SIZE', 500),
+            batch_interval = crawler.settings.getfloat('PIPELINE_BATCH_INTERVAL', 5.0),
+            track_sizes = crawler.settings.getbool('TRACK_SIZES'),
+            restock_watch = crawler.settings.getbool('RESTOCK_WATCH'),
+        )
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.spider_name = spider.name
+        self.resume = getattr(spider, 'checkpointing', False)
+        for country in getattr(spider, 'countries', [COUNTRY_CODE]):
+            self.get_writer(country)
+
+        # flush partially filled batches every `batch_interval` seconds
+        if self.batch_interval > 0:
+            self.start_flush_loop()
+
+    def start_flush_loop(self):
+        self.flush_loop = task.LoopingCall(self.flush)
+        self.flush_loop.start(self.batch_interval, now=False).addErrback(self.flush_failed)
+
+    def flush_failed(self, failure):
+        # a failed flush stops the loop, the items stay buffered for the next one
+        logging.error(f"Flushing buffered items failed, retrying in {self.batch_interval}s: {failure.value!r}")
+        self.start_flush_loop()
+
+    def close_spider(self, spider):
+        if self.flush_loop and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+    def spider_closed(self, spider, reason):
+        # close_spider doesn't know why the crawl ended, the signal does
+        for writer in self.writers.values():
+            writer.finish_run(reason)
 
     def process_item(self, item, spider):
-        product, created_product = Product.get_or_create(
-            zara_id = item.get('id'),
-            defaults = {
-                'name': item.get('name'),
-                'market': item.get('market'),
-                'category': item.get('category'),
-                'description': item.get('description'),
-                'url': item.get('url'),
+        writer = self.get_writer(item.country)
+        if isinstance(item, ListingDone):
+            writer.listings_done.append(item.category_id)
+            return item
+        if isinstance(item, ProductCategoryItem):
+            writer.categories.append((item.product_id, item.category))
+            return item
+        writer.batch.append(item)
+        if len(writer.batch) >= self.batch_size:
+            writer.flush()
+        return item
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def get_writer(self, country):
+        if country not in self.writers:
+            self.writers[country] = MarketWriter(country, get_database(country), self.track_sizes, self.restock_watch, self.spider_name, self.resume)
+        return self.writers[country]
+
+
+class MarketWriter:
+    # buffers and writes the items of one market into that market's database
+    #
+    # with `restock_watch` only tracked products are indexed and sizes of those
+    # coming back in stock are queued as restock notifications. With `resume`
+    # an interrupted run of the spider is continued, see zara_tracker.checkpoint
+    def __init__(self, country, database, track_sizes=False, restock_watch=False, spider_name=None, resume=False):
+        self.country = country
+        self.database = database
+        self.batch = []
+        self.listings_done = []
+        self.categories = []
+        self.restock_watch = restock_watch
+
+        self.database.connect(reuse_if_open=True)
+        migrate(self.database)
+
+        with self.database.bind_ctx(MODELS):
+            tracked = Product.select(Product.id).where(Product.tracking == True) if restock_watch else None
+            self.tracked_product_ids = {product_id for product_id, in tracked.tuples()} if restock_watch else set()
+            self.product_ids = dict(Product.select(Product.zara_id, Product.id).tuples())
+            self.product_categories = set(ProductCategory.select(ProductCategory.product, ProductCategory.category).tuples())
+            self.price_index = ColorPriceIndex.load(tracked)
+            self.media_index = ColorMediaIndex.load(tracked)
+            self.size_index = SizeStateIndex.load(tracked) if track_sizes else None
+            self.run = current_run(spider_name or 'unknown', resume)
+        logging.info(f"{country} - Loaded {len(self.product_ids)} products, {len(self.price_index)} color prices, {len(self.media_index)} color photos and {len(self.size_index or [])} sizes")
+
+    def flush(self):
+        if not self.batch and not self.listings_done and not self.categories:
+            return
+
+        # a listing is done once everything yielded before its marker is stored
+        batch, self.batch = self.batch, []
+        listings_done, self.listings_done = self.listings_done, []
+        categories, self.categories = self.categories, []
+        try:
+            with metrics.measure('flush'), self.database.bind_ctx(MODELS), self.database.atomic():
+                if listings_done:
+                    mark_listings_done(self.run, listings_done)
+                with metrics.measure('store_products'):
+                    product_ids = self.store_products(batch)
+                    product_categories = self.store_categories(product_ids, batch, categories)
+                colors = self.collect_colors(batch)
+                with metrics.measure('store_colors'):
+                    color_ids, traces, changes = self.store_colors(product_ids, colors)
+                    if changes:
+                        self.store_price_changes(product_ids, batch, changes)
+                with metrics.measure('store_media'):
+                    media = self.store_media(color_ids, colors)
+                with metrics.measure('store_sizes'):
+                    sizes, restocks = self.store_sizes(color_ids, colors) if self.size_index is not None else ([], [])
+                if restocks:
+                    self.store_restock_alerts(color_ids, restocks)
+        except Exception:
+            # rolled back, keep the items for the next flush
+            self.batch = batch + self.batch
+            self.listings_done = listings_done + self.listings_done
+            self.categories = categories + self.categories
+            raise
+
+        # only index what has been committed
+        self.product_ids.update(product_ids)
+        self.product_categories.update(product_categories)
+        for product_zara_id, color_zara_id, trace in traces:
+            self.price_index.set(product_zara_id, color_zara_id, trace['color'], trace['price'])
+        for color_id, photos in media.items():
+            self.media_index.set(color_id, photos)
+        for color_id, size_zara_id, size_id, availability, price in sizes:
+            self.size_index.set(color_id, size_zara_id, size_id, availability, price)
+
+        logging.debug(f"{self.country} - Stored batch of {len(batch)} products")
+
+    def close(self):
+        # reports and middlewares open their own connection when they need one
+        self.database.close()
+
+    def finish_run(self, reason):
+        with self.database.bind_ctx(MODELS), self.database.connection_context():
+            finish_run(self.run, reason)
+
+    def store_products(self, items):
+        missing = {}
+        for item in items:
+            if item.id in self.product_ids or item.id in missing:
+                continue
+            missing[item.id] = {
+                'zara_id': item.id,
+                'name': item.name,
+                'market': item.market,
+                'category': item.category,
+                'description': item.description,
+                'url': item.url,
             }
-        )
-        logging.debug(f"{product.name}")
-
-        colors = item.get('colors', [])
-        if colors:
-            self.store_colors(product, colors)
-
-    def store_colors(self, product, colors):
-        for c in colors:
-            color, created_color = Color.get_or_create(
-                zara_id = c.get('id'),
-                product = product,
-                defaults = {
-                    'name': c.get('name'),
-                    'image': c.get('image'),
-                }
-            )
-
-            color_price_trace = ColorPriceTrace.select().where(ColorPriceTrace.color == color).order_by(ColorPriceTrace.created_at.desc()).first()
-
-            if created_color or (color_price_trace and color_price_trace.price != c.get('price')):
-                color_price_trace = ColorPriceTrace.create(
-                    color = color,
-                    price = c.get('price'),
-                    old_price = c.get('old_price'),
-                    original_price = c.get('original_price'),
-                )
-
-            logging.debug(f"{color.product.name} - {color.name}")
-            # sizes = c.get('sizes', [])
-            # if sizes:
-            #     self.store_sizes(color, sizes)
-
-    def store_sizes(self, color: Color, sizes):
-        for s in sizes:
-            size, created_size = Size.get_or_create(
-                zara_id = s.get('id'),
-                color = color,
-                defaults = {
-                    'name': s.get('name'),
-                }
-            )
-            logging.debug(f"{size.color.product.name} - {size.color.name} - {size.name}")
-
-            size_price_trace = SizeAvailabilityTrace.get(
-                (SizeAvailabilityTrace.size == size) &
-                (SizeAvailabilityTrace.availability == s.get('availability'))
-            ).order_by(SizeAvailabilityTrace.created_at.desc())
-
-            if not size_availability_trace or created_size:
-                size_availability_trace = SizeAvailabilityTrace.create(
-                    size = size,
-                    availability = s.get('availability'),
-                )
-                logging.debug(f"{size.color.product.name} - {size.color.name} - {size.name} - Availability")
-
-            size_price_trace = SizePriceTrace.get(
-                (SizePriceTrace.size == size) &
-                (SizePriceTrace.price == s.get('price'))
-            ).order_by(SizePriceTrace.created_at.desc())
-
-            if not size_price_trace or created_size:
-                size_price_trace = SizePriceTrace.create(
-                    size = size,
-                    price = s.get('price'),
-                    old_price = s.get('old_price'),
-                    original_price = s.get('original_price'),
-                )
-                logging.debug(f"{size.color.product.name} - {size.color.name} - {size.name} - Price")
+
+        if not missing:
+            return {}
+
+        for rows in chunked(missing.values(), 100):
+            Product.insert_many(rows).on_conflict_ignore().execute()
+        return self.select_product_ids(missing.keys())
+
+    def store_categories(self, product_ids, items, categories):
+        # categories: (product zara id, category) of copies dropped as duplicates,
+        # only memberships not stored yet are written
+        missing = set()
+        for product_zara_id, category in [(item.id, item.category) for item in items] + categories:
+            product_id = product_ids.get(product_zara_id) or self.product_ids.get(product_zara_id)
+            if category is None or product_id is None or (product_id, category) in self.product_categories:
+                continue
+            missing.add((product_id, category))
+
+        rows = [{'product': product_id, 'category': category} for product_id, category in missing]
+        for chunk in chunked(rows, 200):
+            ProductCategory.insert_many(chunk).on_conflict_ignore().execute()
+        return missing
+
+    def select_product_ids(self, zara_ids):
+        product_ids = {}
+        for ids in chunked(zara_ids, 500):
+            query = Product.select(Product.id, Product.zara_id).where(Product.zara_id.in_(ids)).tuples()
+            for product_id, zara_id in query:
+                product_ids.setdefault(zara_id, product_id)
+        return product_ids
+
+    def collect_colors(self, items):
+        # (product zara id, color zara id) -> color, later duplicates win
+        colors = {}
+        for item in items:
+            for c in item.colors:
+                colors[(item.id, c.id)] = c
+        return colors
+
+    def store_colors(self, product_ids, colors):
+        color_ids = {}
+        traces = []
+        changes = []
+        unknown = []
+        for (product_zara_id, color_zara_id), c in colors.items():
+            known = self.price_index.get(product_zara_id, color_zara_id)
+            if known is None:
+                unknown.append((product_zara_id, color_zara_id))
+                continue
+
+            color_id, last_price = known
+            color_ids[(product_zara_id, color_zara_id)] = color_id
+            if last_price != c.price:
+                traces.append((product_zara_id, color_zara_id, self.make_price_trace(color_id, c)))
+                changes.append((product_zara_id, color_id, last_price, c.price))
+
+        if unknown:
+            color_ids.update(self.store_unknown_colors(product_ids, colors, unknown))
+            for product_zara_id, color_zara_id in unknown:
+                color_id = color_ids[(product_zara_id, color_zara_id)]
+                c = colors[(product_zara_id, color_zara_id)]
+                traces.append((product_zara_id, color_zara_id, self.make_price_trace(color_id, c)))
+
+        for chunk in chunked([trace for _, _, trace in traces], 200):
+            ColorPriceTrace.insert_many(chunk).execute()
+
+        logging.debug(f"Stored {len(colors)} colors, {len(unknown)} new, {len(traces)} price traces")
+        return color_ids, traces, changes
+
+    def store_price_changes(self, product_ids, items, changes):
+        # upserted per (color, day): a second change on the same day replaces
+        # the first one and compares against the price it replaced
+        markets = {item.id: item.market for item in items}
+        now = datetime.datetime.now()
+        rows = [{
+            'color': color_id,
+            'product': product_ids.get(product_zara_id) or self.product_ids[product_zara_id],
+            'market': markets.get(product_zara_id),
+            'date': now.date(),
+            'previous_price': previous_price,
+            'price': price,
+            'percent': (price - previous_price) * 100 / previous_price,
+            'changed_at': now,
+        } for product_zara_id, color_id, previous_price, price in changes if previous_price]
+
+        for chunk in chunked(rows, 100):
+            DailyPriceChange.insert_many(chunk).on_conflict(
+                conflict_target=[DailyPriceChange.color, DailyPriceChange.date],
+                preserve=[DailyPriceChange.previous_price, DailyPriceChange.price, DailyPriceChange.percent, DailyPriceChange.changed_at],
+            ).execute()
+
+    def store_unknown_colors(self, product_ids, colors, unknown):
+        # colors missing from the price index, usually new ones
+        def product_id(product_zara_id):
+            return product_ids.get(product_zara_id) or self.product_ids[product_zara_id]
+
+        db_product_ids = {product_id(product_zara_id) for product_zara_id, _ in unknown}
+        color_ids = self.select_color_ids(db_product_ids)
+
+        rows = [{
+            'product': product_id(product_zara_id),
+            'zara_id': color_zara_id,
+            'name': colors[(product_zara_id, color_zara_id)].name,
+        } for product_zara_id, color_zara_id in unknown if (product_id(product_zara_id), color_zara_id) not in color_ids]
+
+        if rows:
+            for chunk in chunked(rows, 200):
+                Color.insert_many(chunk).on_conflict_ignore().execute()
+            color_ids = self.select_color_ids(db_product_ids)
+
+        return {
+            (product_zara_id, color_zara_id): color_ids[(product_id(product_zara_id), color_zara_id)]
+            for product_zara_id, color_zara_id in unknown
+        }
+
+    def select_color_ids(self, product_ids):
+        color_ids = {}
+        for ids in chunked(product_ids, 500):
+            query = Color.select(Color.id, Color.product, Color.zara_id).where(Color.product.in_(ids)).tuples()
+            for color_id, product_id, zara_id in query:
+                color_ids.setdefault((product_id, zara_id), color_id)
+        return color_ids
+
+    def store_media(self, color_ids, colors):
+        # only colors showing other photos than last time are rewritten. Items
+        # without photos (the stock spider's) leave the stored ones alone
+        changed = {}
+        new = {}
+        for key, c in colors.items():
+            if not c.photos:
+                continue
+            color_id = color_ids[key]
+            if color_id not in self.media_index:
+                new[color_id] = c.photos
+            elif self.media_index.changed(color_id, c.photos):
+                changed[color_id] = c.photos
+
+        if changed:
+            store_color_media(changed)
+        if new:
+            store_color_media(new, replace=False)
+        return changed | new
+
+    def make_price_trace(self, color_id, c):
+        return {
+            'color': color_id,
+            'run': self.run.id,
+            'price': c.price,
+            'old_price': c.old_price,
+            'original_price': c.original_price,
+        }
+
+    def store_sizes(self, color_ids, colors):
+        # only sizes whose availability or price changed get a new trace row
+        availability_traces = []
+        price_traces = []
+        states = []
+        restocks = []
+        unknown = []
+
+        for key, c in colors.items():
+            color_id = color_ids[key]
+            for s in c.sizes:
+                size_zara_id = s.id
+                known = self.size_index.get(color_id, size_zara_id)
+                if known is None:
+                    unknown.append((color_id, size_zara_id, s))
+                    continue
+
+                size_id, availability, price = known
+                if availability != s.availability:
+                    availability_traces.append(self.make_availability_trace(size_id, s))
+                if price != s.price:
+                    price_traces.append(self.make_size_price_trace(size_id, s))
+                if availability != s.availability or price != s.price:
+                    states.append((color_id, size_zara_id, size_id, s.availability, s.price))
+                if self.restock_watch and availability not in IN_STOCK and s.availability in IN_STOCK:
+                    restocks.append((key, s))
+
+        if unknown:
+            size_ids = self.store_unknown_sizes(unknown)
+            for color_id, size_zara_id, s in unknown:
+                size_id = size_ids[(color_id, size_zara_id)]
+                availability_traces.append(self.make_availability_trace(size_id, s))
+                price_traces.append(self.make_size_price_trace(size_id, s))
+                states.append((color_id, size_zara_id, size_id, s.availability, s.price))
+
+        for chunk in chunked(availability_traces, 300):
+            SizeAvailabilityTrace.insert_many(chunk).execute()
+        for chunk in chunked(price_traces, 200):
+            SizePriceTrace.insert_many(chunk).execute()
+
+        logging.debug(f"Stored {len(unknown)} new sizes, {len(availability_traces)} availability and {len(price_traces)} price traces")
+        return states, restocks
+
+    def store_restock_alerts(self, color_ids, restocks):
+        # product id -> color id -> size names back in stock
+        restocked = {}
+        for (product_zara_id, color_zara_id), s in restocks:
+            product_id = self.product_ids[product_zara_id]
+            if product_id in self.tracked_product_ids:
+                restocked.setdefault(product_id, {}).setdefault(color_ids[(product_zara_id, color_zara_id)], []).append(s.name)
+
+        if not restocked:
+            return
+
+        products = {p.id: p for p in Product.select().where(Product.id.in_(list(restocked)))}
+        color_ids = [color_id for sizes in restocked.values() for color_id in sizes]
+        colors = {c.id: c for c in Color.select().where(Color.id.in_(color_ids))}
+        images = color_images(color_ids)
+
+        rows = []
+        for product_id, sizes in restocked.items():
+            product = products[product_id]
+            message = f"*{product.name}*\n\nBack in stock\n"
+            for color_id, names in sizes.items():
+                message += f"_{colors[color_id].name}_: {', '.join(names)}\n"
+            message += f"\n[Product page]({product.url})"
+
+            rows.append({
+                'product': product_id,
+                'kind': 'restock',
+                'market': product.market,
+                'images': ', '.join(images.get(next(iter(sizes)), [])),
+                'message': message,
+            })
+            logging.info(f"{self.country} - {product.name} - Back in stock, Notifying")
+
+        # one alert per product and day
+        Notification.insert_many(rows).on_conflict_ignore().execute()
+
+    def store_unknown_sizes(self, unknown):
+        # sizes missing from the size index, usually new ones
+        color_ids = {color_id for color_id, _, _ in unknown}
+        size_ids = self.select_size_ids(color_ids)
+
+        rows = [{
+            'color': color_id,
+            'zara_id': size_zara_id,
+            'name': s.name,
+        } for color_id, size_zara_id, s in unknown if (color_id, size_zara_id) not in size_ids]
+
+        if rows:
+            for chunk in chunked(rows, 300):
+                Size.insert_many(chunk).on_conflict_ignore().execute()
+            size_ids = self.select_size_ids(color_ids)
+
+        return size_ids
+
+    def select_size_ids(self, color_ids):
+        size_ids = {}
+        for ids in chunked(color_ids, 500):
+            query = Size.select(Size.id, Size.color, Size.zara_id).where(Size.color.in_(ids)).tuples()
+            for size_id, color_id, zara_id in query:
+                size_ids[(color_id, zara_id)] = size_id
+        return size_ids
+
+    def make_availability_trace(self, size_id, s):
+        return {
+            'size': size_id,
+            'availability': s.availability,
+        }
+
+    def make_size_price_trace(self, size_id, s):
+        return {
+            'size': size_id,
+            'price': s.price,
+            'old_price': s.old_price,
+            'original_price': s.original_price,
+        }
@@ -16,12 +16,14 @@ BOT_NAME = "zara_tracker"
 
 SPIDER_MODULES = ["zara_tracker.spiders"]
 NEWSPIDER_MODULE = "zara_tracker.spiders"
+COMMANDS_MODULE = "zara_tracker.commands"
 
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
+# per endpoint limits are set by AdaptiveThrottleMiddleware, see below
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -48,17 +50,27 @@ ROBOTSTXT_OBEY = True
 #SPIDER_MIDDLEWARES = {
 #    "zara_tracker.middlewares.ZaraTrackerSpiderMiddleware": 543,
 #}
+SPIDER_MIDDLEWARES = {
+    "zara_tracker.middlewares.ProductDeduplicationMiddleware": 543,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #DOWNLOADER_MIDDLEWARES = {
 #    "zara_tracker.middlewares.ZaraTrackerDownloaderMiddleware": 543,
 #}
+DOWNLOADER_MIDDLEWARES = {
+    # after HttpCompressionMiddleware (590) so responses are hashed decompressed
+    "zara_tracker.middlewares.ConditionalRequestMiddleware": 580,
+    # before RetryMiddleware (550) so every retried 429/403 is seen
+    "zara_tracker.middlewares.AdaptiveThrottleMiddleware": 560,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 EXTENSIONS = {
    "scrapy.extensions.telnet.TelnetConsole": None,
+   "zara_tracker.extensions.InstrumentationExtension": 500,
 }
 
 # Configure item pipelines
@@ -102,6 +114,12 @@ FEED_EXPORT_ENCODING = "utf-8"
 PLAYWRIGHT_LAUNCH_OPTIONS = {
     "headless": True,
 }
+PLAYWRIGHT_MAX_CONTEXTS = int(os.getenv('PLAYWRIGHT_MAX_CONTEXTS', 2))
+PLAYWRIGHT_MAX_PAGES_PER_CONTEXT = int(os.getenv('PLAYWRIGHT_MAX_PAGES_PER_CONTEXT', 4))
+# pages kept open and reused between products
+PLAYWRIGHT_POOL_SIZE = int(os.getenv('PLAYWRIGHT_POOL_SIZE', 8))
+# seconds to wait for window.zara.viewPayload
+PLAYWRIGHT_PAYLOAD_TIMEOUT = int(os.getenv('PLAYWRIGHT_PAYLOAD_TIMEOUT', 15))
 
 ITEM_PIPELINES = {
    "zara_tracker.pipelines.ZaraTrackerPipeline": 300,
@@ -123,6 +141,81 @@ TG_THREAD_K = os.getenv('TG_THREAD_K')
 TG_THREAD_Z = os.getenv('TG_THREAD_Z')
 TG_THREAD_B = os.getenv('TG_THREAD_B')
 TG_ERROR_CHAT_ID = os.getenv('TG_ERROR_CHAT_ID')
+TG_API_URL = os.getenv('TG_API_URL', 'https://api.telegram.org')
+TG_WORKERS = int(os.getenv('TG_WORKERS', 4))
+TG_RATE_GLOBAL = float(os.getenv('TG_RATE_GLOBAL', 30))  # messages per second
+TG_RATE_PER_CHAT = float(os.getenv('TG_RATE_PER_CHAT', 20))  # messages per minute
+TG_MAX_RETRIES = int(os.getenv('TG_MAX_RETRIES', 5))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', 5))
 DATABASE_FILEPATH = os.getenv('DATABASE_FILEPATH')
+# SQLite profile applied on every connection, see items.database_pragmas
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'wal')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'normal')
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64000))  # negative is KiB, 64MB
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 30))  # seconds to wait for a lock
 COUNTRY_CODE = os.getenv('COUNTRY_CODE', 'pl')
 LANGUAGE_CODE = os.getenv('LANGUAGE_CODE', 'pl')
+# markets crawled by one process, e.g. "pl:pl,nl:nl"
+MARKETS = os.getenv('MARKETS', f'{COUNTRY_CODE}:{LANGUAGE_CODE}')
+
+# Pipeline batching, items are written in one transaction per batch
+PIPELINE_BATCH_SIZE = int(os.getenv('PIPELINE_BATCH_SIZE', 500))
+PIPELINE_BATCH_INTERVAL = float(os.getenv('PIPELINE_BATCH_INTERVAL', 5))
+
+# Size level availability and price traces, written only when they change
+TRACK_SIZES = os.getenv('TRACK_SIZES', 'false').lower() in ('1', 'true', 'yes')
+
+# Skip category listings that did not change since the last finished crawl
+CONDITIONAL_REQUESTS_ENABLED = os.getenv('CONDITIONAL_REQUESTS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Decode category listings element by element to keep peak memory low
+PRICES_STREAMING_JSON = os.getenv('PRICES_STREAMING_JSON', 'false').lower() in ('1', 'true', 'yes')
+
+# Per endpoint AIMD concurrency/delay controller, replaces AutoThrottle
+ADAPTIVE_THROTTLE_ENABLED = os.getenv('ADAPTIVE_THROTTLE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ADAPTIVE_THROTTLE_START_CONCURRENCY = int(os.getenv('ADAPTIVE_THROTTLE_START_CONCURRENCY', 2))
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = {
+    "categories": 2,
+    "listing": int(os.getenv('ADAPTIVE_THROTTLE_MAX_LISTING', 16)),
+    "product": int(os.getenv('ADAPTIVE_THROTTLE_MAX_PRODUCT', 8)),
+    "static": 8,
+}
+ADAPTIVE_THROTTLE_TARGET_LATENCY = float(os.getenv('ADAPTIVE_THROTTLE_TARGET_LATENCY', 2))  # seconds
+ADAPTIVE_THROTTLE_MIN_DELAY = float(os.getenv('ADAPTIVE_THROTTLE_MIN_DELAY', 0))
+ADAPTIVE_THROTTLE_MAX_DELAY = float(os.getenv('ADAPTIVE_THROTTLE_MAX_DELAY', 30))
+
+# Stage timings and SQL counters in the crawl stats, optionally exported for
+# the node_exporter textfile collector and/or as JSON when the crawl ends
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+INSTRUMENTATION_PROMETHEUS_FILE = os.getenv('INSTRUMENTATION_PROMETHEUS_FILE')
+INSTRUMENTATION_JSON_FILE = os.getenv('INSTRUMENTATION_JSON_FILE')
+
+# Month partitions of price traces moved out of the database by `scrapy compact`
+PRICE_ARCHIVE_DIRECTORY = os.getenv('PRICE_ARCHIVE_DIRECTORY', 'data/archive')
+PRICE_ARCHIVE_AFTER_DAYS = int(os.getenv('PRICE_ARCHIVE_AFTER_DAYS', 90))
+
+# Leaf categories are cached for CATEGORY_TREE_TTL hours, listings are
+# revisited between CATEGORY_REVISIT_MIN and CATEGORY_REVISIT_MAX hours apart
+# depending on how often their prices changed
+CATEGORY_SCHEDULING_ENABLED = os.getenv('CATEGORY_SCHEDULING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CATEGORY_TREE_TTL = float(os.getenv('CATEGORY_TREE_TTL', 24))
+CATEGORY_REVISIT_MIN = float(os.getenv('CATEGORY_REVISIT_MIN', 1))
+CATEGORY_REVISIT_MAX = float(os.getenv('CATEGORY_REVISIT_MAX', 72))
+
+# The listings of a prices crawl are checkpointed, a crawl that was interrupted
+# less than CRAWL_RESUME_MAX_AGE hours ago resumes where it stopped
+CRAWL_CHECKPOINTS_ENABLED = os.getenv('CRAWL_CHECKPOINTS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CRAWL_RESUME_MAX_AGE = float(os.getenv('CRAWL_RESUME_MAX_AGE', 24))
+
+# Sharded crawling (`scrapy crawl prices_coordinator` and any number of
+# `scrapy crawl prices_worker`) shares listings and results through this file.
+# Workers claim WORK_QUEUE_BATCH listings at a time and own them for
+# WORK_QUEUE_LEASE seconds, they stop after WORK_QUEUE_IDLE_TIMEOUT seconds
+# without work
+WORK_QUEUE_FILEPATH = os.getenv('WORK_QUEUE_FILEPATH', 'data/queue.db')
+WORK_QUEUE_LEASE = float(os.getenv('WORK_QUEUE_LEASE', 600))
+WORK_QUEUE_BATCH = int(os.getenv('WORK_QUEUE_BATCH', 4))
+WORK_QUEUE_IDLE_TIMEOUT = float(os.getenv('WORK_QUEUE_IDLE_TIMEOUT', 60))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv('WORK_QUEUE_MAX_ATTEMPTS', 3))
+WORK_QUEUE_POLL_INTERVAL = float(os.getenv('WORK_QUEUE_POLL_INTERVAL', 1))
@@ -1,17 +1,41 @@
 import scrapy
+import hashlib
 import logging
-from zara_tracker.items import ColorPriceTrace, Color, Product
+import sys
+import time
+from zara_tracker.items import ColorPriceTrace, Color, Product, Notification, DailyPriceChange, CategorySchedule, MODELS, \
+    ProductItem, ColorItem, SizeItem, Photo, ListingDone, get_database
+from zara_tracker.checkpoint import current_run, plan_listings, planned_listings, unreported_runs, mark_reported
 import datetime
-from zara_tracker.telegram import send_telegram_message
 from peewee import *
-from zara_tracker.settings import COUNTRY_CODE, LANGUAGE_CODE, TG_TOKEN
+from zara_tracker.instrumentation import metrics
+from zara_tracker.media import color_images
+from zara_tracker.jsonstream import find_path, iter_json_array
+from zara_tracker.markets import parse_markets
+from zara_tracker.settings import MARKETS
 
 class PricesSpider(scrapy.Spider):
     name = "prices"
     allowed_domains = ["www.zara.com"]
-    start_urls = [f"https://www.zara.com/{COUNTRY_CODE}/{LANGUAGE_CODE}/categories?ajax=true"]
     sections_to_track = ["WOMAN", "MAN", "KID", "BEAUTY", "ZARA ORIGINS"]
     minimal_price_drop_percentage = 25
+    change_rate_smoothing = 0.3
+
+    def __init__(self, markets=MARKETS, full=False, *args, **kwargs):
+        # scrapy crawl prices -a markets=pl:pl,nl:nl
+        #
+        # -a full=true refreshes the category tree and crawls every listing,
+        # due or not
+        super().__init__(*args, **kwargs)
+        self.markets = parse_markets(markets)
+        self.full = str(full).lower() in ('1', 'true', 'yes')
+        self.schedules = {}  # country -> {category id: CategorySchedule}
+        self.observations = {}  # country -> {category id: price hash, None if the listing was unchanged}
+        self.runs = {}  # country -> CrawlRun
+
+    @property
+    def countries(self):
+        return [country for country, _ in self.markets]
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -20,50 +44,77 @@ class PricesSpider(scrapy.Spider):
         return spider
 
     def share_discount_reports(self):
-        date = datetime.date.today()
-        color_price_trace_sub_filter = ColorPriceTrace.alias('cpt') \
-            .select(SQL('cpt.id')) \
-            .where(
-                (SQL('date(cpt.created_at)') == SQL(f"date('{date}')")) \
-            )
-
-        changed_product_ids_of_the_day = ColorPriceTrace.select(Product.id.distinct()) \
-            .join(Color) \
-            .join(Product) \
-            .where(ColorPriceTrace.id << color_price_trace_sub_filter) \
-            .group_by(Color.id) \
-            .having(fn.Count(Color.id) > 1)
-
-        changed_products = Product.select().where(Product.id.in_(changed_product_ids_of_the_day))
-
-        for changed_product in changed_products:
-            has_significant_price_drop = False
-
-            for color in changed_product.colors:
-                price_traces = color.price_traces.order_by(ColorPriceTrace.created_at.desc())
-
-                if len(price_traces) <= 1:
-                    logging.info(f"{changed_product.name} - {color.name} - Only 1 price tracked for this color, ignoring")
-                    continue
-
-                current_price = price_traces[0].price
-                previous_price = price_traces[1].price
-
-                # don't notify if price increased
-                if current_price >= previous_price:
-                    logging.info(f"{changed_product.name} - {color.name} - Price increased, ignoring. Previous price: {previous_price/100:.2f}, Current price: {current_price/100:.2f}")
-                    continue
-
-                # only notify if price drop is X% or higher
-                discount_percentage = (previous_price - current_price) / previous_price * 100
-                logging.info(f"{changed_product.name} - {color.name} - Current price: {current_price}, Previous price: {previous_price/100:.2f}, Discount percentage {discount_percentage}, Notifying {discount_percentage >= self.minimal_price_drop_percentage}")
-                if discount_percentage >= self.minimal_price_drop_percentage:
-                    has_significant_price_drop = True
-
-            if has_significant_price_drop and TG_TOKEN:
-                self.announce_product_price_change(changed_product)
+        for country in self.countries:
+            database = get_database(country)
+            if not self.checkpointing:
+                with metrics.measure('report'):
+                    self.share_market_discount_reports(country, database, get_database(country, readonly=True))
+                continue
 
-    def announce_product_price_change(self, product):
+            # once per completed run, a run interrupted midway is reported by
+            # the process completing it
+            with database.bind_ctx(MODELS), database.connection_context():
+                runs = unreported_runs(self.name)
+            for run in runs:
+                with metrics.measure('report'):
+                    self.share_market_discount_reports(country, database, get_database(country, readonly=True), run.started_at, run.completed_at)
+                with database.bind_ctx(MODELS), database.connection_context():
+                    mark_reported(run)
+
+    def share_market_discount_reports(self, country, database, reader=None, since=None, until=None):
+        # alerts go to the outbox, `scrapy notify` delivers them. The report
+        # itself reads through `reader`, only the outbox insert takes the write lock
+        #
+        # drops changed within [since, until] (today by default) are reported.
+        # Runs pass their own window, one crossing midnight doesn't report the
+        # drops of the run before it again under the next day's date
+        date = datetime.date.today()
+        since = since or datetime.datetime.combine(date, datetime.time())
+
+        reader = reader or database
+        notifications = []
+        with reader.bind_ctx(MODELS), reader.connection_context():
+            products = self.find_discounted_products(since, until)
+            colors = Color.select()
+            price_traces = ColorPriceTrace.select().order_by(ColorPriceTrace.created_at)
+
+            products = prefetch(products, colors, price_traces)
+            # the photos of a product's last color go with its message
+            images = color_images([product.colors[-1].id for product in products if product.colors])
+
+            for product in products:
+                logging.info(f"{country} - {product.name} - Price dropped by {self.minimal_price_drop_percentage}% or more, Notifying")
+                message = self.make_price_change_message(product)
+                notifications.append({
+                    'product': product.id,
+                    'kind': 'discount',
+                    'date': date,
+                    'market': product.market,
+                    'images': ', '.join(images.get(product.colors[-1].id, []) if product.colors else []),
+                    'message': message,
+                })
+
+        # one alert per product and day, re-running the report doesn't queue it twice
+        with database.bind_ctx(MODELS), database.connection_context(), database.atomic():
+            for rows in chunked(notifications, 100):
+                Notification.insert_many(rows).on_conflict_ignore().execute()
+
+        logging.info(f"{country} - Queued {len(notifications)} discount notifications")
+
+    def find_discounted_products(self, since, until=None):
+        # the pipeline keeps one DailyPriceChange per color and day, so this is
+        # a range read on the (date, percent) index
+        discounted = (DailyPriceChange.date >= since.date()) \
+            & (DailyPriceChange.percent <= -self.minimal_price_drop_percentage) \
+            & (DailyPriceChange.changed_at >= since)
+        if until is not None:
+            discounted &= DailyPriceChange.changed_at <= until
+        discounted_product_ids = DailyPriceChange.select(DailyPriceChange.product).where(discounted)
+
+        return Product.select().where(Product.id.in_(discounted_product_ids))
+
+    def make_price_change_message(self, product):
+        # expects colors and their price traces (oldest first) to be prefetched
         message = f"*{product.name}*\n\n"
 
         for color in product.colors:
@@ -71,7 +122,7 @@ class PricesSpider(scrapy.Spider):
 
             prices = []
             last_price = None
-            for price_trace in color.price_traces.order_by(ColorPriceTrace.created_at):
+            for price_trace in color.price_traces:
                 percentage = None if last_price is None else ((price_trace.price - last_price) / last_price * 100)
                 percentage_text = f" ({round(percentage):+}%)" if percentage else ""
                 prices.append(f"{price_trace.created_at:%Y-%m-%d}: {round(price_trace.price / 100, 2):.2f}{percentage_text}")
@@ -84,35 +135,223 @@ class PricesSpider(scrapy.Spider):
 
         message += f"[Product page]({product.url})"
 
-        send_telegram_message(product.market, color.image.split(", "), message)
+        return message
+
+    @property
+    def scheduling(self):
+        return self.settings.getbool('CATEGORY_SCHEDULING_ENABLED')
+
+    @property
+    def checkpointing(self):
+        return self.settings.getbool('CRAWL_CHECKPOINTS_ENABLED')
+
+    def start_requests(self):
+        for country, language in self.markets:
+            if self.checkpointing:
+                pending = self.resume_run(country)
+                if pending is not None:
+                    logging.info(f"{country} - Resuming crawl run {self.runs[country].id}, {len(pending)} listings left")
+                    if self.scheduling:
+                        # rescheduled as usual once crawled
+                        self.load_schedules(country)
+                    yield from self.dispatch(country, [
+                        self.listing_request(country, language, listing.market, {'id': listing.category_id, 'name': listing.name})
+                        for listing in pending
+                    ])
+                    continue
+
+            if self.scheduling and not self.full and self.load_schedules(country):
+                logging.info(f"{country} - Using the cached category tree")
+                yield from self.plan(country, self.listing_requests(country, language))
+                continue
+
+            yield scrapy.Request(
+                f"https://www.zara.com/{country}/{language}/categories?ajax=true",
+                cb_kwargs = {
+                    "country": country,
+                    "language": language,
+                },
+            )
 
-    def parse(self, response):
+    def parse(self, response, country, language):
         payload = response.json()
 
+        categories = []
         sections = payload['categories']
         for section in sections:  # woman, man, kid, beauty, origins
             section_name = section.get('sectionName', section['name'])
 
             if section_name in self.sections_to_track:
                 for category in self.process_category(section, []):
-                    # print(f"Requesting category {category['id']}")
-                    yield scrapy.Request(
-                        f"https://www.zara.com/{COUNTRY_CODE}/{LANGUAGE_CODE}/category/{category['id']}/products?ajax=true",
-                        callback = self.parse_products,
-                        cb_kwargs = {
-                            "market": section_name,
-                            "category": category,
-                        }
-                    )
-
-    def parse_products(self, response, market, category):
-        payload = response.json()
+                    categories.append((section_name, category))
 
-        if not payload.get('productGroups'):
-            logging.debug(f"{market}:{category['id']} - 'productGroups' is missing\n{payload.keys()}")
+        if not self.scheduling:
+            yield from self.plan(country, [self.listing_request(country, language, section_name, category) for section_name, category in categories])
             return
 
-        elements = payload['productGroups'][0]['elements']
+        self.store_category_tree(country, categories)
+        yield from self.plan(country, self.listing_requests(country, language))
+
+    def listing_request(self, country, language, market, category, priority=0):
+        return scrapy.Request(
+            f"https://www.zara.com/{country}/{language}/category/{category['id']}/products?ajax=true",
+            callback = self.parse_products,
+            priority = priority,
+            cb_kwargs = {
+                "market": market,
+                "category": category,
+                "country": country,
+                "language": language,
+            },
+            meta = {"conditional": True},
+        )
+
+    def listing_requests(self, country, language):
+        # due listings, the ones whose prices change most often first
+        now = datetime.datetime.now()
+        skipped = 0
+        for schedule in sorted(self.schedules[country].values(), key=lambda schedule: -schedule.priority):
+            if not self.full and schedule.next_crawl_at and schedule.next_crawl_at > now:
+                skipped += 1
+                continue
+            category = {'id': schedule.category_id, 'name': schedule.name}
+            yield self.listing_request(country, language, schedule.market, category, schedule.priority)
+
+        logging.info(f"{country} - Requested {len(self.schedules[country]) - skipped} listings, {skipped} are not due yet")
+
+    def resume_run(self, country):
+        # -> pending listings of an interrupted run, None if the crawl starts over
+        database = get_database(country)
+        with database.bind_ctx(MODELS):
+            self.runs[country] = current_run(self.name, resume=True)
+            return planned_listings(self.runs[country])
+
+    def plan(self, country, requests):
+        # the listings of the run are stored before any of them is requested
+        requests = list(requests)
+        if self.checkpointing:
+            database = get_database(country)
+            with database.bind_ctx(MODELS), database.atomic():
+                plan_listings(self.runs[country], [
+                    (request.cb_kwargs['category']['id'], request.cb_kwargs['market'], request.cb_kwargs['category']['name'])
+                    for request in requests
+                ])
+        return self.dispatch(country, requests)
+
+    def dispatch(self, country, requests):
+        # listing requests of a market, see PricesCoordinatorSpider
+        return requests
+
+    def load_schedules(self, country):
+        # True when the cached category tree is younger than CATEGORY_TREE_TTL
+        reader = get_database(country, readonly=True)
+        with reader.bind_ctx(MODELS), reader.connection_context():
+            self.schedules[country] = {schedule.category_id: schedule for schedule in CategorySchedule.select()}
+
+        refreshed_at = max((schedule.refreshed_at for schedule in self.schedules[country].values()), default=None)
+        ttl = datetime.timedelta(hours=self.settings.getfloat('CATEGORY_TREE_TTL'))
+        return refreshed_at is not None and refreshed_at > datetime.datetime.now() - ttl
+
+    def store_category_tree(self, country, categories):
+        now = datetime.datetime.now()
+        rows = {}
+        for market, category in categories:
+            # a category listed in several sections is crawled once, like the dupefilter did
+            rows.setdefault(category['id'], {
+                'category_id': category['id'],
+                'market': market,
+                'name': category['name'],
+                'refreshed_at': now,
+            })
+
+        database = get_database(country)
+        with database.bind_ctx(MODELS), database.atomic():
+            for chunk in chunked(rows.values(), 100):
+                CategorySchedule.insert_many(chunk).on_conflict(
+                    conflict_target=[CategorySchedule.category_id],
+                    preserve=[CategorySchedule.market, CategorySchedule.name, CategorySchedule.refreshed_at],
+                ).execute()
+            # categories that disappeared from the tree
+            removed = CategorySchedule.delete().where(CategorySchedule.refreshed_at < now).execute()
+            self.schedules[country] = {schedule.category_id: schedule for schedule in CategorySchedule.select()}
+
+        logging.info(f"{country} - Stored category tree with {len(rows)} categories, {removed} removed")
+
+    def closed(self, reason):
+        # feed what this crawl saw of every listing back into its schedule
+        if not self.scheduling:
+            return
+
+        now = datetime.datetime.now()
+        for country, observations in self.observations.items():
+            schedules = self.schedules.get(country, {})
+            database = get_database(country)
+            with database.bind_ctx(MODELS), database.connection_context(), database.atomic():
+                for category_id, price_hash in observations.items():
+                    schedule = schedules.get(category_id)
+                    if schedule is None:
+                        continue
+                    changed = price_hash is not None and price_hash != schedule.price_hash
+                    if price_hash is not None:
+                        schedule.price_hash = price_hash
+                    self.reschedule(schedule, changed, now)
+                    schedule.save()
+
+            logging.info(f"{country} - Rescheduled {len(observations)} listings")
+
+    def reschedule(self, schedule, changed, now):
+        # hot listings are revisited every CATEGORY_REVISIT_MIN hours, the
+        # interval grows inversely with the change rate up to CATEGORY_REVISIT_MAX
+        schedule.change_rate = self.change_rate_smoothing * changed + (1 - self.change_rate_smoothing) * schedule.change_rate
+        minimum = self.settings.getfloat('CATEGORY_REVISIT_MIN') * 3600
+        maximum = self.settings.getfloat('CATEGORY_REVISIT_MAX') * 3600
+        schedule.revisit_interval = min(maximum, minimum / max(schedule.change_rate, minimum / maximum))
+        schedule.priority = round(schedule.change_rate * 100)
+        schedule.last_crawled_at = now
+        schedule.next_crawl_at = now + datetime.timedelta(seconds=schedule.revisit_interval)
+
+    def observe(self, country, category_id, prices):
+        # prices: sorted (product, color, price) tuples of the listing, None if unchanged
+        price_hash = None if prices is None else hashlib.blake2b(repr(prices).encode(), digest_size=16).hexdigest()
+        self.observations.setdefault(country, {})[category_id] = price_hash
+
+    def parse_products(self, response, market, category, country, language):
+        if response.meta.get('unchanged'):
+            logging.debug(f"{market}:{category['id']} - Listing unchanged since last crawl, skipping")
+            self.observe(country, category['id'], None)
+            yield from self.listing_done(country, category)
+            return
+
+        # shared by every item of the listing
+        market = sys.intern(market)
+        category_name = sys.intern(category['name'])
+
+        if self.settings.getbool('PRICES_STREAMING_JSON'):
+            # decode one element at a time instead of the whole listing, the
+            # time spent decoding is recorded once all of them were read
+            text = response.text
+            started = time.perf_counter()
+            product_group = find_path(text, ('productGroups', 0))
+            located = time.perf_counter() - started
+            if product_group is None:
+                metrics.observe('parse_json', located)
+                logging.debug(f"{market}:{category['id']} - 'productGroups' is missing")
+                yield from self.listing_done(country, category)
+                return
+
+            elements = metrics.measure_iteration('parse_json', iter_json_array(text, ('elements',), product_group), located)
+        else:
+            with metrics.measure('parse_json'):
+                payload = response.json()
+
+            if not payload.get('productGroups'):
+                logging.debug(f"{market}:{category['id']} - 'productGroups' is missing\n{payload.keys()}")
+                yield from self.listing_done(country, category)
+                return
+
+            elements = payload['productGroups'][0]['elements']
+
+        prices = []
         for element in elements:
             com_components = element.get('commercialComponents')
 
@@ -128,20 +367,33 @@ class PricesSpider(scrapy.Spider):
                     logging.debug(f"{market}:{category['id']} - 'detail' or 'colors' or 'name' or 'seo' are missing\n{com_component.keys()}")
                     continue
 
-                product_url = self.make_url(com_component['seo'], category['id'])
+                product_url = self.make_url(com_component['seo'], category['id'], country, language)
                 if not product_url:
                     logging.debug(f"{market}:{category['id']} - 'product_url' is missing")
                     continue
 
-                yield {
-                    'id': com_component['seo']['seoProductId'],
-                    'name': com_component['name'],
-                    'market': market,
-                    'url': product_url,
-                    'category': category['name'],
-                    'description': com_component.get('description', ''),
-                    'colors': self.map_colors(com_component['detail']['colors'], market, category),
-                }
+                with metrics.measure('map_colors'):
+                    colors = self.map_colors(com_component['detail']['colors'], market, category)
+                prices.extend((com_component['seo']['seoProductId'], color.id, color.price) for color in colors)
+
+                yield ProductItem(
+                    id=int(com_component['seo']['seoProductId']),
+                    name=com_component['name'],
+                    country=country,
+                    market=market,
+                    url=product_url,
+                    category=category_name,
+                    description=com_component.get('description', ''),
+                    colors=colors,
+                )
+
+        # listing order changes often, only the prices matter for the schedule
+        self.observe(country, category['id'], sorted(prices))
+        yield from self.listing_done(country, category)
+
+    def listing_done(self, country, category):
+        if self.checkpointing:
+            yield ListingDone(country, category['id'])
 
     def map_colors(self, colors, market, category):
         items = []
@@ -159,28 +411,29 @@ class PricesSpider(scrapy.Spider):
         return items
 
     def map_color(self, color):
-        return {
-            "id": color['id'],
-            "name": color['name'],
-            "price": color['price'],
-            "old_price": color.get('oldPrice', None),
-            "original_price": color.get('originalPrice', None),
-            "image": self.make_photo_urls(color['xmedia']),
-            "sizes": self.map_sizes(color.get('sizes', []))
-        }
+        # positional, this runs for every color of every listing
+        return ColorItem(
+            int(color['id']),
+            sys.intern(color['name']),
+            color['price'],
+            color.get('oldPrice', None),
+            color.get('originalPrice', None),
+            self.map_photos(color['xmedia']),
+            self.map_sizes(color.get('sizes', [])),
+        )
 
     def map_sizes(self, sizes):
         return [self.map_size(size) for size in sizes]
 
     def map_size(self, size):
-        return {
-            "id": size['id'],
-            "name": size['name'],
-            "availability": size['availability'],
-            "price": size['price'],
-            "old_price": size.get('oldPrice', None),
-            "original_price": size.get('originalPrice', None)
-        }
+        return SizeItem(
+            int(size['id']),
+            sys.intern(size['name']),
+            sys.intern(size['availability']),
+            size['price'],
+            size.get('oldPrice', None),
+            size.get('originalPrice', None),
+        )
 
     def process_category(self, category, categories):
         for subcategory in category['subcategories']:
@@ -207,24 +460,17 @@ class PricesSpider(scrapy.Spider):
             return name.replace('-', '_')
         return name
 
-    def make_url(self, seo: dict, category_id: str) -> str | None:
+    def make_url(self, seo: dict, category_id: str, country: str, language: str) -> str | None:
         if not seo.get('keyword'):
             return
         keyword = seo['keyword']
         seo_product_id = seo['seoProductId']
         discern_product_id = seo['discernProductId']
-        url = f"https://www.zara.com/{COUNTRY_CODE}/{LANGUAGE_CODE}/{keyword}-p{seo_product_id}.html?v1={discern_product_id}&v2={category_id}"
+        url = f"https://www.zara.com/{country}/{language}/{keyword}-p{seo_product_id}.html?v1={discern_product_id}&v2={category_id}"
         return url
 
-    def make_photo_urls(self, photos: list) -> str:
-        photos_list = []
-        for photo in photos:
-            path = photo['path']
-            name = photo['name']
-            timestamp = photo['timestamp']
-            photo_str = f"https://static.zara.net/photos//{path}/w/750/{name}.jpg?ts={timestamp}"
-            photos_list.append(photo_str)
-        return ', '.join(photos_list)
+    def map_photos(self, photos: list) -> tuple:
+        return tuple(Photo(photo['path'], photo['name'], photo['timestamp']) for photo in photos)
 
     def get_percentage(self, price: int, price_old: int) -> str:
         percent = round(-1 * (100 - (price * 100 / price_old)))
@@ -0,0 +1,187 @@
+import logging
+import os
+import socket
+import time
+
+import scrapy
+from scrapy.exceptions import DontCloseSpider
+
+from zara_tracker.spiders.prices import PricesSpider
+from zara_tracker.index import ColorPriceIndex, ColorMediaIndex
+from zara_tracker.items import ProductItem, ProductCategoryItem, MODELS, get_database
+from zara_tracker.workqueue import WorkQueue, encode_record, decode_record
+
+# The prices crawl split over processes or machines sharing WORK_QUEUE_FILEPATH:
+#
+#   scrapy crawl prices_coordinator -a markets=pl:pl,nl:nl
+#   scrapy crawl prices_worker      (as many as there are cores)
+#
+# The coordinator resolves the category tree and schedules like `prices`, but
+# queues the listings instead of requesting them. Workers download and parse
+# listings and send back the products that changed; the coordinator stores
+# them through the usual pipeline, so it is the only process writing to a
+# market database.
+
+
+class PricesCoordinatorSpider(PricesSpider):
+    name = "prices_coordinator"
+    records_per_poll = 50
+    # a listing is only done once its records are stored, the queue relies on it
+    custom_settings = {
+        "CRAWL_CHECKPOINTS_ENABLED": True,
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = None
+        self.polled_at = 0
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(PricesCoordinatorSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.queue = WorkQueue(crawler.settings.get('WORK_QUEUE_FILEPATH'), crawler.settings.getfloat('WORK_QUEUE_LEASE'),
+                                 crawler.settings.getint('WORK_QUEUE_MAX_ATTEMPTS'))
+        crawler.signals.connect(spider.spider_idle, signal=scrapy.signals.spider_idle)
+        return spider
+
+    def dispatch(self, country, requests):
+        run = self.runs[country]
+        self.queue.put([{
+            'country': country,
+            'language': request.cb_kwargs['language'],
+            'run': run.id,
+            'category_id': request.cb_kwargs['category']['id'],
+            'market': request.cb_kwargs['market'],
+            'name': request.cb_kwargs['category']['name'],
+            'priority': request.priority,
+        } for request in requests])
+        logging.info(f"{country} - Queued {len(requests)} listings of crawl run {run.id}")
+        return []
+
+    def spider_idle(self, spider):
+        # records are applied from a data: request, so their items go through
+        # the spider middlewares and pipelines like any other
+        runs = {country: run.id for country, run in self.runs.items()}
+        if not self.queue.outstanding(runs):
+            return
+
+        if time.monotonic() - self.polled_at >= self.settings.getfloat('WORK_QUEUE_POLL_INTERVAL'):
+            self.polled_at = time.monotonic()
+            self.crawler.engine.crawl(scrapy.Request("data:,", callback=self.apply_records, dont_filter=True, meta={"download_slot": "workqueue"}))
+        raise DontCloseSpider
+
+    def apply_records(self, response):
+        records = self.queue.consume(self.records_per_poll)
+        for record in records:
+            products, categories = decode_record(record.payload, record.country)
+            yield from products
+            # unchanged products aren't sent, their categories are
+            for product_id, category in categories:
+                yield ProductCategoryItem(record.country, product_id, category)
+            self.observations.setdefault(record.country, {})[record.category_id] = record.price_hash
+            yield from self.listing_done(record.country, {'id': record.category_id})
+
+        if records:
+            self.crawler.stats.inc_value('workqueue/applied', len(records))
+            # more may be waiting, don't wait for the poll interval
+            self.polled_at = 0
+
+    def closed(self, reason):
+        super().closed(reason)
+        if reason == 'finished':
+            self.queue.clear({country: run.id for country, run in self.runs.items()})
+
+
+class PricesWorkerSpider(PricesSpider):
+    name = "prices_worker"
+    # workers never write to a market database: no pipeline, and neither the
+    # validators of conditional requests nor schedules are stored here
+    custom_settings = {
+        "ITEM_PIPELINES": {},
+        "CONDITIONAL_REQUESTS_ENABLED": False,
+        "CRAWL_CHECKPOINTS_ENABLED": False,
+        "CATEGORY_SCHEDULING_ENABLED": False,
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = None
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.worked_at = time.monotonic()
+        self.snapshots = {}  # country -> (run id, ColorPriceIndex, ColorMediaIndex)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        # not PricesSpider.from_crawler, the coordinator reports
+        spider = super(PricesSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.queue = WorkQueue(crawler.settings.get('WORK_QUEUE_FILEPATH'), crawler.settings.getfloat('WORK_QUEUE_LEASE'),
+                                 crawler.settings.getint('WORK_QUEUE_MAX_ATTEMPTS'))
+        crawler.signals.connect(spider.spider_idle, signal=scrapy.signals.spider_idle)
+        return spider
+
+    def start_requests(self):
+        return self.claim_requests()
+
+    def claim_requests(self):
+        tasks = self.queue.claim(self.worker, self.settings.getint('WORK_QUEUE_BATCH'))
+        if tasks:
+            self.worked_at = time.monotonic()
+        requests = []
+        for task in tasks:
+            request = self.listing_request(task.country, task.language, task.market, {'id': task.category_id, 'name': task.name}, task.priority)
+            request.meta['task'] = task
+            requests.append(request.replace(errback=self.listing_failed))
+        return requests
+
+    def spider_idle(self, spider):
+        for request in self.claim_requests():
+            self.crawler.engine.crawl(request)
+
+        idle = time.monotonic() - self.worked_at
+        if idle < self.settings.getfloat('WORK_QUEUE_IDLE_TIMEOUT'):
+            raise DontCloseSpider
+        logging.info(f"No listings queued for {round(idle)}s, stopping")
+
+    def parse_products(self, response, market, category, country, language):
+        # the listing is sent as one record, nothing is yielded here
+        task = response.meta['task']
+        products = [item for item in super().parse_products(response, market, category, country, language) if isinstance(item, ProductItem)]
+        changed = [product for product in products if self.changed(product, task.run)]
+        categories = [(product.id, product.category) for product in products]
+        self.queue.publish(task, self.observations.get(country, {}).get(category['id']), encode_record(changed, categories))
+        self.crawler.stats.inc_value('workqueue/published')
+        self.crawler.stats.inc_value('workqueue/unchanged', len(products) - len(changed))
+        self.worked_at = time.monotonic()
+
+    def changed(self, product, run):
+        # products whose colors all have the price and photos the database had
+        # when this run's snapshot was taken wouldn't be written, they aren't
+        # sent. With sizes tracked every product is
+        if self.settings.getbool('TRACK_SIZES'):
+            return True
+
+        # a run starts once the one before it completed, so a snapshot taken
+        # within the run holds every price stored by earlier runs. One kept
+        # from an earlier run would miss a price going back to what it was
+        snapshot = self.snapshots.get(product.country)
+        if snapshot is None or snapshot[0] != run:
+            reader = get_database(product.country, readonly=True)
+            with reader.bind_ctx(MODELS), reader.connection_context():
+                snapshot = self.snapshots[product.country] = (run, ColorPriceIndex.load(), ColorMediaIndex.load())
+            logging.info(f"{product.country} - Loaded {len(snapshot[1])} color prices of crawl run {run} to compare against")
+
+        _, prices, media = snapshot
+        for c in product.colors:
+            known = prices.get(product.id, c.id)
+            if known is None or known[1] != c.price or media.changed(known[0], c.photos):
+                return True
+        return False
+
+    def listing_failed(self, failure):
+        task = failure.request.meta['task']
+        logging.warning(f"{task.country} - Listing {task.category_id} failed: {failure.value!r}")
+        self.queue.release(task)
+
+    def closed(self, reason):
+        # listings are rescheduled by the coordinator
+        pass
@@ -1,7 +1,20 @@
-from scrapy import Spider, Request
-# from zara_tracker.items import ZaraTrackerItem, ZaraTrackerItemColor, ZaraTrackerItemColorSize
+import time
+
+from scrapy import Spider, Request, signals
+from scrapy.exceptions import DontCloseSpider
+from w3lib.url import add_or_replace_parameter
+from zara_tracker.items import Product, MODELS, ProductItem, ColorItem, SizeItem, get_database
+from zara_tracker.markets import parse_markets
+from zara_tracker.settings import MARKETS
 
 class ZaraSpider(Spider):
+    # Polls the products marked with `Product.tracking` and queues a restock
+    # notification when one of their sizes comes back in stock.
+    #
+    #   scrapy crawl zara -a markets=pl:pl,nl:nl -a interval=300
+    #
+    # Products are fetched from the JSON version of the product page, the
+    # browser is only used when that doesn't return a product payload.
     name = "zara"
     allowed_domains = ["www.zara.com"]
     custom_settings = {
@@ -10,56 +23,149 @@ class ZaraSpider(Spider):
             "https": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
             "http": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
         },
+        "PLAYWRIGHT_ABORT_REQUEST": "zara_tracker.browser.should_abort_request",
+        "TRACK_SIZES": True,
+        "RESTOCK_WATCH": True,
+        "CONDITIONAL_REQUESTS_ENABLED": False,
     }
 
+    def __init__(self, markets=MARKETS, interval=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.markets = parse_markets(markets)
+        self.interval = float(interval) if interval else None
+        self.polled_at = None
+        self.browser_fallbacks = 0
+        self.idle_pages = []
+
+    @property
+    def countries(self):
+        return [country for country, _ in self.markets]
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(ZaraSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
     def start_requests(self):
-        urls = [
-            "https://www.zara.com/pl/pl/bluza-o-krotszym-kroju-z-kolekcji-basic-p08417803.html?v1=278099829",
-            "https://www.zara.com/pl/pl/taliowana-sukienka-z-odkrytymi-plecami-p03641823.html?v1=290317149&v2=2354324",
-            "https://www.zara.com/pl/pl/sukienka-sredniej-d%C5%82ugosci-z-wycieciami-p02298143.html?v1=267134062&v2=2354324&origin=shopcart",
-            "https://www.zara.com/pl/pl/sukienka-w-stylu-bieliznianym-na-ramiaczkach-z-bizuteryjnymi-zdobieniami-p09196845.html?v1=316715661&v2=2354274",
-            "https://www.zara.com/pl/pl/sukienka-sredniej-d%C5%82ugosci-na-ramiaczkach-z-plecionki-p07806670.html?v1=270399873&v2=2354274",
-        ]
-
-        for url in urls:
-            yield Request(url, meta={
-                "playwright": True,
-                "playwright_include_page": True,
-            })
-
-    async def parse(self, response, **kwargs):
-        page = response.meta["playwright_page"]
-        payload = await page.evaluate("window.zara.viewPayload");
-        await page.close()
+        return self.poll_requests()
+
+    def spider_idle(self):
+        # keep polling every `interval` seconds instead of closing
+        if not self.interval:
+            return
+        if time.monotonic() - self.polled_at >= self.interval:
+            for request in self.poll_requests():
+                self.crawler.engine.crawl(request)
+        raise DontCloseSpider
+
+    def poll_requests(self):
+        self.polled_at = time.monotonic()
+
+        for country, _ in self.markets:
+            reader = get_database(country, readonly=True)
+            with reader.bind_ctx(MODELS), reader.connection_context():
+                products = list(Product.select(Product.zara_id, Product.url).where(Product.tracking == True).tuples())
+            self.logger.info(f"{country} - Polling {len(products)} tracked products")
+
+            for zara_id, url in products:
+                yield Request(
+                    add_or_replace_parameter(url, "ajax", "true"),
+                    callback = self.parse_json,
+                    dont_filter = True,
+                    cb_kwargs = {
+                        "country": country,
+                        "zara_id": zara_id,
+                        "url": url,
+                    },
+                )
+
+    def parse_json(self, response, country, zara_id, url):
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+
+        if not isinstance(payload, dict) or not payload.get('product'):
+            self.browser_fallbacks += 1
+            self.crawler.stats.inc_value("restock/browser_fallback")
+            yield self.browser_request(url, country, zara_id)
+            return
 
-        yield {
-            "id": payload['product']['id'],
-            "name": payload['product']['name'],
-            "colors": self.map_colors(payload['product']['detail']['colors'])
+        yield self.make_item(payload, country, zara_id)
+
+    def browser_request(self, url, country, zara_id):
+        meta = {
+            "playwright": True,
+            "playwright_include_page": True,
+            # spread pages over a fixed set of reused browser contexts
+            "playwright_context": f"restock-{self.browser_fallbacks % self.settings.getint('PLAYWRIGHT_MAX_CONTEXTS', 2)}",
+            # viewPayload is read as soon as it exists, see parse
+            "playwright_page_goto_kwargs": {"wait_until": "commit"},
         }
+        if self.idle_pages:
+            meta["playwright_page"] = self.idle_pages.pop()
+
+        return Request(url, dont_filter=True, meta=meta, errback=self.browser_failed, cb_kwargs={
+            "country": country,
+            "zara_id": zara_id,
+        })
+
+    async def parse(self, response, country, zara_id, **kwargs):
+        page = response.meta["playwright_page"]
+        try:
+            await page.wait_for_function("() => window.zara && window.zara.viewPayload", timeout=self.settings.getint('PLAYWRIGHT_PAYLOAD_TIMEOUT') * 1000)
+            payload = await page.evaluate("window.zara.viewPayload");
+        except Exception:
+            await page.close()
+            raise
+
+        await self.release_page(page)
+        yield self.make_item(payload, country, zara_id)
+
+    async def release_page(self, page):
+        # keep up to PLAYWRIGHT_POOL_SIZE pages around for the next fallbacks
+        if len(self.idle_pages) < self.settings.getint('PLAYWRIGHT_POOL_SIZE'):
+            self.idle_pages.append(page)
+        else:
+            await page.close()
+
+    async def browser_failed(self, failure):
+        page = failure.request.meta.get("playwright_page")
+        if page:
+            await page.close()
+        self.logger.warning(f"Browser fallback failed for {failure.request.url}: {failure.value}")
+
+    def make_item(self, payload, country, zara_id):
+        return ProductItem(
+            id=zara_id,
+            name=payload['product']['name'],
+            country=country,
+            colors=self.map_colors(payload['product']['detail']['colors']),
+        )
 
     def map_colors(self, colors):
         return [self.map_color(color) for color in colors]
 
     def map_color(self, color):
-        return {
-            "id": color['id'],
-            "name": color['name'],
-            "price": color['price'],
-            "old_price": color.get('oldPrice', None),
-            "original_price": color.get('originalPrice', None),
-            "sizes": self.map_sizes(color['sizes'])
-        }
+        return ColorItem(
+            id=int(color['id']),
+            name=color['name'],
+            price=color['price'],
+            old_price=color.get('oldPrice', None),
+            original_price=color.get('originalPrice', None),
+            sizes=self.map_sizes(color['sizes']),
+        )
 
     def map_sizes(self, sizes):
         return [self.map_size(size) for size in sizes]
 
     def map_size(self, size):
-        return {
-            "id": size['id'],
-            "name": size['name'],
-            "availability": size['availability'],
-            "price": size['price'],
-            "old_price": size.get('oldPrice', None),
-            "original_price": size.get('originalPrice', None)
-        }
+        return SizeItem(
+            id=int(size['id']),
+            name=size['name'],
+            availability=size['availability'],
+            price=size['price'],
+            old_price=size.get('oldPrice', None),
+            original_price=size.get('originalPrice', None),
+        )
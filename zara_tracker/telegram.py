@@ -1,39 +1,205 @@
-import time
+import heapq
+import itertools
 import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from zara_tracker import settings
+from zara_tracker.settings import TG_TOKEN, TG_API_URL, TG_WORKERS, TG_RATE_GLOBAL, TG_RATE_PER_CHAT, TG_MAX_RETRIES
+
+
+class TelegramError(Exception):
+    pass
+
+
+class TelegramMessage:
+    def __init__(self, method: str, params: dict, future: Future):
+        self.method = method
+        self.params = params
+        self.future = future
+        self.attempts = 0
+
+    @property
+    def chat_id(self):
+        return self.params.get('chat_id')
+
+
+class TelegramNotifier:
+    # Queues messages and sends them from a small pool of worker threads that
+    # share one HTTP connection pool. Sending never blocks the caller: `send`
+    # returns a Future and rate limits / retry_after are honoured by
+    # rescheduling the message instead of sleeping on it.
+
+    def __init__(self, token=TG_TOKEN, api_url=TG_API_URL, workers=TG_WORKERS,
+                 global_rate=TG_RATE_GLOBAL, chat_rate=TG_RATE_PER_CHAT, max_retries=TG_MAX_RETRIES, backoff=1.0):
+        self.url = f"{api_url.rstrip('/')}/bot{token}"
+        self.global_interval = 1 / global_rate  # messages per second over all chats
+        self.chat_interval = 60 / chat_rate  # messages per minute in one chat
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (ready_at, sequence, message)
+        self.sequence = itertools.count()
+        self.chat_ready_at = {}
+        self.global_ready_at = 0
+        self.unfinished = 0
+        self.closed = False
+
+        self.workers = [threading.Thread(target=self.work, name=f"telegram-{i}", daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def send(self, method: str, params: dict) -> Future:
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise TelegramError("Notifier is closed")
+            self.unfinished += 1
+            self.schedule(TelegramMessage(method, params, future), time.monotonic())
+        return future
+
+    def send_media_group(self, chat_id, thread_id, images: list, caption: str) -> Future:
+        media = [{'type': 'photo', 'media': path, 'parse_mode': 'HTML'} for path in images]
+        media[0]['caption'] = caption
+        media[0]['parse_mode'] = 'Markdown'
 
-from zara_tracker.settings import TG_TOKEN, TG_CHAT_ID, TG_THREAD_W, TG_THREAD_M, TG_THREAD_K, TG_THREAD_B, TG_THREAD_Z
+        return self.send('sendMediaGroup', {
+            'chat_id': chat_id,
+            'message_thread_id': thread_id,
+            'media': json.dumps(media),
+        })
 
-def send_telegram_message(market, images, message):
+    def send_text(self, chat_id, thread_id, text: str) -> Future:
+        return self.send('sendMessage', {
+            'chat_id': chat_id,
+            'message_thread_id': thread_id,
+            'text': text,
+            'parse_mode': 'Markdown',
+        })
+
+    def join(self, timeout=None) -> bool:
+        # wait until every queued message is delivered or has failed
+        with self.condition:
+            return self.condition.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def close(self, timeout=None) -> bool:
+        delivered = self.join(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.session.close()
+        return delivered
+
+    def schedule(self, message: TelegramMessage, ready_at: float):
+        # must be called while holding the condition
+        heapq.heappush(self.queue, (ready_at, next(self.sequence), message))
+        self.condition.notify()
+
+    def next_message(self):
+        with self.condition:
+            while True:
+                if not self.queue:
+                    if self.closed:
+                        return None
+                    self.condition.wait()
+                    continue
+
+                ready_at, _, message = self.queue[0]
+                allowed_at = max(ready_at, self.chat_ready_at.get(message.chat_id, 0))
+                if allowed_at > ready_at:
+                    # chat is rate limited, let messages for other chats go first
+                    heapq.heapreplace(self.queue, (allowed_at, next(self.sequence), message))
+                    continue
+
+                now = time.monotonic()
+                wait = max(ready_at, self.global_ready_at) - now
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+
+                heapq.heappop(self.queue)
+                self.chat_ready_at[message.chat_id] = now + self.chat_interval
+                self.global_ready_at = now + self.global_interval
+                return message
+
+    def work(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            self.deliver(message)
+
+    def deliver(self, message: TelegramMessage):
+        message.attempts += 1
+        retry_after = None
+        try:
+            r = self.session.post(f"{self.url}/{message.method}", data=message.params, timeout=30)
+            if r.status_code == 200:
+                return self.finish(message, result=r.json())
+
+            error = TelegramError(f"{message.method} failed with HTTP {r.status_code}: {r.text[:200]}")
+            if r.status_code == 429:
+                retry_after = r.json().get('parameters', {}).get('retry_after')
+            elif r.status_code < 500:
+                return self.finish(message, error=error)
+        except (requests.RequestException, ValueError) as e:
+            error = e
+
+        if message.attempts > self.max_retries:
+            return self.finish(message, error=error)
+
+        delay = retry_after if retry_after is not None else self.backoff * 2 ** (message.attempts - 1)
+        logging.info(f"Telegram {message.method} to {message.chat_id} failed ({error}), retrying in {delay}s")
+        with self.condition:
+            ready_at = time.monotonic() + delay
+            if retry_after is not None:
+                self.chat_ready_at[message.chat_id] = max(self.chat_ready_at.get(message.chat_id, 0), ready_at)
+            self.schedule(message, ready_at)
+
+    def finish(self, message: TelegramMessage, result=None, error=None):
+        if error is None:
+            message.future.set_result(result)
+        else:
+            logging.error(f"Telegram {message.method} to {message.chat_id} failed: {error}")
+            message.future.set_exception(error)
+
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+
+def send_telegram_message(notifier: TelegramNotifier, country, market, images, message) -> Future:
     print("Sending message on telegram")
+    images = [image for image in images if image]
+    if not images:
+        return notifier.send_text(determine_chat_id(country), determine_thread_id(country, market), message)
+    return notifier.send_media_group(determine_chat_id(country), determine_thread_id(country, market), images, message)
+
+def telegram_setting(name: str, country: str):
+    # per market overrides like TG_CHAT_ID_NL, falling back to TG_CHAT_ID
+    return os.getenv(f"{name}_{country.upper()}") or getattr(settings, name)
 
-    url = f'https://api.telegram.org/bot{TG_TOKEN}/sendMediaGroup'
-    params = {
-        'chat_id': TG_CHAT_ID,
-        'message_thread_id': determine_thread_id(market),
-        'media': [],
-    }
-
-    for path in images:
-        params['media'].append({'type': 'photo', 'media': path, 'parse_mode': 'HTML'})
-
-    params['media'][0]['caption'] = message
-    params['media'][0]['parse_mode'] = 'Markdown'
-    params['media'] = json.dumps(params['media'])
-
-    r = requests.post(url, data=params)
-    if r.status_code != 200:
-        data = r.json()
-        time_to_sleep = data['parameters']['retry_after']
-        time.sleep(time_to_sleep)
-        send_telegram_message(market, images, message)
-
-def determine_thread_id(market: str):
-    return {
-        "WOMAN": TG_THREAD_W,
-        "MAN": TG_THREAD_M,
-        "KID": TG_THREAD_K,
-        "BEAUTY": TG_THREAD_B,
-        "ZARA ORIGINS": TG_THREAD_Z,
-    }[market]
+def determine_chat_id(country: str):
+    return telegram_setting("TG_CHAT_ID", country)
 
+def determine_thread_id(country: str, market: str):
+    return telegram_setting({
+        "WOMAN": "TG_THREAD_W",
+        "MAN": "TG_THREAD_M",
+        "KID": "TG_THREAD_K",
+        "BEAUTY": "TG_THREAD_B",
+        "ZARA ORIGINS": "TG_THREAD_Z",
+    }[market], country)
@@ -0,0 +1,169 @@
+import datetime
+import json
+import logging
+import operator
+import os
+import zlib
+from functools import reduce
+
+from peewee import *
+from zara_tracker.items import ProductItem, ColorItem, SizeItem, Photo, InstrumentedSqliteDatabase, database_pragmas
+from zara_tracker.settings import WORK_QUEUE_FILEPATH, WORK_QUEUE_LEASE, WORK_QUEUE_MAX_ATTEMPTS, SQLITE_BUSY_TIMEOUT
+
+# Work queue between the prices coordinator and its workers, see
+# zara_tracker/spiders/sharded.py. One sqlite file shared by every process:
+#
+#   coordinator -> QueueTask:     category listings of its runs
+#   workers     -> ChangeRecord:  the changed products of a listing and the
+#                                 categories of all of them, compact
+#   coordinator:                  applies the records, it is the only writer
+#                                 of the market databases
+#
+# Tasks are leased for WORK_QUEUE_LEASE seconds, the listing of a worker that
+# died is handed out again once its lease ran out. WorkQueue is all the
+# spiders see of it, a broker can take its place when workers run on other
+# machines than the queue file.
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueModel(Model):
+    pass
+
+class QueueTask(QueueModel):
+    country = CharField()
+    language = CharField()
+    run = IntegerField()  # CrawlRun id in the market's database
+    category_id = IntegerField()
+    market = CharField()
+    name = CharField()
+    priority = IntegerField(default=0)
+    status = CharField(default=PENDING)
+    worker = CharField(null=True)
+    leased_until = DateTimeField(null=True)
+    attempts = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('country', 'run', 'category_id'), True),
+            (('status', 'priority'), False),
+        )
+
+class ChangeRecord(QueueModel):
+    task = IntegerField()
+    country = CharField()
+    category_id = IntegerField()
+    price_hash = CharField(null=True)
+    payload = BlobField()
+    created_at = DateTimeField(default=datetime.datetime.now)
+
+QUEUE_MODELS = [QueueTask, ChangeRecord]
+
+
+def encode_record(products: list, categories: list) -> bytes:
+    # the changed products of a listing and (product id, category) of every
+    # product in it. Field values go without their names, every listing
+    # repeats them thousands of times
+    return zlib.compress(json.dumps([[[
+        p.id, p.name, p.market, p.url, p.category, p.description, [[
+            c.id, c.name, c.price, c.old_price, c.original_price,
+            [list(photo) for photo in c.photos],
+            [[s.id, s.name, s.availability, s.price, s.old_price, s.original_price] for s in c.sizes],
+        ] for c in p.colors],
+    ] for p in products], categories], separators=(',', ':')).encode())
+
+
+def decode_record(payload: bytes, country: str) -> tuple:
+    # -> (products, [(product id, category), ...])
+    encoded_products, categories = json.loads(zlib.decompress(payload))
+    products = []
+    for product_id, name, market, url, category, description, colors in encoded_products:
+        products.append(ProductItem(product_id, name, country, market, url, category, description, [
+            ColorItem(
+                color_id, color_name, price, old_price, original_price,
+                tuple(Photo(*photo) for photo in photos),
+                [SizeItem(*size) for size in sizes],
+            )
+            for color_id, color_name, price, old_price, original_price, photos, sizes in colors
+        ]))
+    return products, [tuple(pair) for pair in categories]
+
+
+class WorkQueue:
+    def __init__(self, path=WORK_QUEUE_FILEPATH, lease=WORK_QUEUE_LEASE, max_attempts=WORK_QUEUE_MAX_ATTEMPTS):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.database = InstrumentedSqliteDatabase(path, pragmas=database_pragmas(), timeout=SQLITE_BUSY_TIMEOUT)
+        # one queue per process, the models stay bound to it
+        self.database.bind(QUEUE_MODELS)
+        self.database.create_tables(QUEUE_MODELS, safe=True)
+        self.lease = datetime.timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+
+    def put(self, tasks: list):
+        # tasks: dicts of QueueTask fields. A resumed run queues its pending
+        # listings again: failed ones get new attempts and done ones whose
+        # record was lost with the coordinator are crawled again
+        record_queued = SQL('EXISTS (SELECT 1 FROM changerecord WHERE changerecord.task = queuetask.id)')
+        for chunk in chunked(tasks, 100):
+            QueueTask.insert_many(chunk).on_conflict(
+                conflict_target=[QueueTask.country, QueueTask.run, QueueTask.category_id],
+                update={QueueTask.status: PENDING, QueueTask.attempts: 0, QueueTask.worker: None, QueueTask.leased_until: None},
+                where=(QueueTask.status == FAILED) | ((QueueTask.status == DONE) & ~record_queued),
+            ).execute()
+
+    def claim(self, worker: str, limit: int) -> list:
+        # pending tasks and those whose lease ran out, highest priority first
+        now = datetime.datetime.now()
+        with self.database.atomic('IMMEDIATE'):
+            tasks = list(QueueTask
+                         .select()
+                         .where((QueueTask.status == PENDING) | ((QueueTask.status == LEASED) & (QueueTask.leased_until < now)))
+                         .order_by(QueueTask.priority.desc(), QueueTask.id)
+                         .limit(limit))
+            if tasks:
+                QueueTask \
+                    .update(status=LEASED, worker=worker, leased_until=now + self.lease, attempts=QueueTask.attempts + 1) \
+                    .where(QueueTask.id.in_([task.id for task in tasks])) \
+                    .execute()
+        return tasks
+
+    def publish(self, task: QueueTask, price_hash: str | None, payload: bytes):
+        # the record and the finished task are committed together
+        with self.database.atomic():
+            ChangeRecord.create(task=task.id, country=task.country, category_id=task.category_id, price_hash=price_hash, payload=payload)
+            QueueTask.update(status=DONE, leased_until=None).where(QueueTask.id == task.id).execute()
+
+    def release(self, task: QueueTask):
+        # a failed listing is retried by any worker until it ran out of attempts
+        with self.database.atomic():
+            attempts = QueueTask.select(QueueTask.attempts).where(QueueTask.id == task.id).scalar() or 0
+            status = FAILED if attempts >= self.max_attempts else PENDING
+            QueueTask.update(status=status, worker=None, leased_until=None).where(QueueTask.id == task.id).execute()
+        if status == FAILED:
+            logging.warning(f"{task.country} - Listing {task.category_id} failed {attempts} times, giving up")
+
+    def consume(self, limit: int) -> list:
+        # records are deleted once read. One lost with the coordinator leaves
+        # its listing pending in the run, which queues it again when resumed
+        with self.database.atomic('IMMEDIATE'):
+            records = list(ChangeRecord.select().order_by(ChangeRecord.id).limit(limit))
+            if records:
+                ChangeRecord.delete().where(ChangeRecord.id.in_([record.id for record in records])).execute()
+        return records
+
+    def outstanding(self, runs: dict) -> bool:
+        # True while listings of `runs` (country -> run id) are queued, being
+        # crawled or waiting to be applied
+        if not runs:
+            return False
+        of_runs = reduce(operator.or_, [(QueueTask.country == country) & (QueueTask.run == run_id) for country, run_id in runs.items()])
+        return QueueTask.select().where(of_runs & QueueTask.status.in_([PENDING, LEASED])).exists() or ChangeRecord.select().exists()
+
+    def clear(self, runs: dict):
+        # tasks of completed runs
+        for country, run_id in runs.items():
+            QueueTask.delete().where((QueueTask.country == country) & (QueueTask.run == run_id)).execute()
+